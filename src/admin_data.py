@@ -7,12 +7,12 @@ import logging
 import os
 from pprint import pformat
 
-from flask import Flask, render_template, request
+from flask import Flask, jsonify, render_template, request
 
 from browser import views as browse
 from btfs import sessions
 from data import api, db, views
-from data.cache import memcache3
+from data.cache import cache_stats, memcache3
 from data.model import Chunk, Dir, File
 
 
@@ -39,9 +39,11 @@ def find_orphans(limit=1000):
             dir_orphans.append(item.key())
     output += "Orphan Files:\n"
     file_keys = {}
+    content_keys = {}
     file_orphans = []
     for item in File.ilist_all(1000):
         file_keys[item.key()] = item
+        content_keys[item.get_content_key()] = item.key()
         try:
             key = item.parent_path
         except Exception:
@@ -62,7 +64,7 @@ def find_orphans(limit=1000):
     chunk_orphans = []
     for item in Chunk.ilist_all(1000, projection=["offset"]):
         try:
-            key = item.key().parent
+            key = content_keys.get(item.key().parent, item.key().parent)
         except Exception:
             output += "Invalid Reference: %s\n" % item.key()
             chunk_orphans.append(item.key())
@@ -110,6 +112,8 @@ def admin_view():
         "expired_sessions": expired_sessions,
         "check_orphans": check_orphans,
         "delete_orphans": delete_orphans,
+        "rebuild_aggregates": rebuild_aggregates,
+        "collect_content": collect_content,
     }
     # Handle admin commands
     if qs in actions:
@@ -143,6 +147,13 @@ def admin_view():
     return render_template("admin_data.html", **template_values)
 
 
+@app.route("/_admin/stats.json")
+@sessions.flask_authorize("admin")
+def admin_stats():
+    """Return the cache statistics of this process and the totals for all processes."""
+    return jsonify(cache_stats.get_stats())
+
+
 def run_tests():
     from btfs.test import test
 
@@ -210,6 +221,29 @@ def check_orphans():
     return output
 
 
+def rebuild_aggregates():
+    # directories saved before we kept count and total_size - this scans each subtree
+    total = 0
+    cursor = None
+    while True:
+        dirs, cursor = Dir.list_page(1000, cursor)
+        for item in dirs:
+            if item.get_aggregates()[1] is None:
+                item.rebuild_aggregates()
+                total += 1
+        if cursor is None:
+            break
+    output = "Rebuilt the aggregates of %s dirs. <a href='?'>Back</a>" % total
+    return output
+
+
+def collect_content():
+    # replaced or deleted content that is due, including what other instances left
+    total = File.collect_content()
+    output = "Deleted %s chunks of old content. <a href='?'>Back</a>" % total
+    return output
+
+
 def delete_orphans():
     output, dir_orphans, file_orphans, chunk_orphans = find_orphans()
     total = 0
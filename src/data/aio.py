@@ -0,0 +1,132 @@
+#
+# Copyright (c) 2019-2020 Mike's Pub, see https://github.com/mikespub-org
+# Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
+#
+"""
+Asyncio variants of the file system operations in data.fs and data.model.
+
+The datastore client is blocking, so each operation runs the sync version in a
+thread pool. From one event loop you can then start many of them at once, e.g.::
+
+    contents = await aio.get_content_multi(paths)
+"""
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import fs
+from .model import Path
+
+# separate from db.get_executor(), which the sync operations use themselves (e.g. read-ahead)
+MAX_WORKERS = 64
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is not None:
+        return _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="datastore-aio"
+            )
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Run the blocking func in the thread pool and wait for the result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+async def run_multi(func, items):
+    """Run func(item) for all items concurrently - returns the results in order"""
+    return await asyncio.gather(*(run(func, item) for item in items))
+
+
+async def aiter_sync(iterator):
+    """Iterate over a blocking iterator (e.g. iget_content) without blocking the loop"""
+    iterator = iter(iterator)
+    sentinel = object()
+    while True:
+        item = await run(next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+
+async def _getresource(path, environ=None):
+    if isinstance(path, Path):
+        return path
+    return await run(fs._getresource, path, environ)
+
+
+async def retrieve(path, environ=None):
+    return await run(Path.retrieve, path, environ)
+
+
+async def retrieve_multi(paths, environ=None):
+    return await run(Path.retrieve_multi, paths, environ)
+
+
+async def get_content(path):
+    """Return the data of a file, or the list of children of a directory"""
+    p = await _getresource(path)
+    if p is None:
+        raise ValueError("source not found %r" % path)
+    return await run(p.get_content)
+
+
+async def get_content_multi(paths):
+    """Return the data of all files - they are retrieved in one batch first"""
+    found = await retrieve_multi(paths)
+    files = []
+    for path in paths:
+        p = found.get(Path.normalize(path))
+        if p is None:
+            raise ValueError("source not found %r" % path)
+        files.append(p)
+    return await run_multi(lambda p: p.get_content(), files)
+
+
+async def iget_content(path):
+    """Iterate over the chunk data of a file, or the children of a directory"""
+    p = await _getresource(path)
+    if p is None:
+        raise ValueError("source not found %r" % path)
+    async for item in aiter_sync(p.iget_content()):
+        yield item
+
+
+async def put_content(path, data):
+    p = await _getresource(path)
+    if p is None:
+        p = await run(fs.mkfile, path)
+    await run(p.put_content, data)
+    return p
+
+
+async def listdir(path, environ=None):
+    return await run(fs.listdir, path, environ)
+
+
+async def scandir(path, environ=None):
+    return await run(fs.scandir, path, environ)
+
+
+async def mkdir(path):
+    return await run(fs.mkdir, path)
+
+
+async def unlink(path):
+    return await run(fs.unlink, path)
+
+
+async def rmtree(path):
+    logging.debug("aio.rmtree(%r)" % path)
+    return await run(fs.rmtree, path)
@@ -339,6 +339,16 @@ class ListAPI(MethodView):
         sort = request.args.get("sort", None)
         fields = request.args.get("fields", None)
         filters = parse_filter_args(request.args, name)
+        # use ?cursor= for the first page, and the X-Next-Cursor header for the next
+        if "cursor" in request.args:
+            cursor = request.args.get("cursor") or None
+            result, next_cursor = list_get_page(
+                name, cursor, sort, fields, filters=filters
+            )
+            response = jsonify(result)
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return response
         if filters:
             result = list_get(name, page, sort, fields, filters=filters)
         else:
@@ -376,6 +386,36 @@ def ilist_get(name, page=1, sort=None, fields=None, truncate=True, filters=None)
         page = 1
     limit = PAGE_SIZE
     offset = (page - 1) * limit
+    kwargs = get_query_args(sort, fields, filters)
+    if name not in KNOWN_MODELS:
+        for entity in db.ilist_entities(name, limit, offset, **kwargs):
+            info = item_to_dict(entity, truncate=truncate)
+            yield info
+    else:
+        for instance in KNOWN_MODELS[name].ilist_all(limit, offset, **kwargs):
+            info = instance_to_dict(instance, truncate=truncate)
+            yield info
+
+
+def list_get_page(
+    name, cursor=None, sort=None, fields=None, truncate=True, filters=None
+):
+    """Get a page of entities of kind starting at cursor - returns (result, next_cursor)"""
+    limit = PAGE_SIZE
+    kwargs = get_query_args(sort, fields, filters)
+    result = []
+    if name not in KNOWN_MODELS:
+        entities, next_cursor = db.list_entities_page(name, limit, cursor, **kwargs)
+        for entity in entities:
+            result.append(item_to_dict(entity, truncate=truncate))
+    else:
+        instances, next_cursor = KNOWN_MODELS[name].list_page(limit, cursor, **kwargs)
+        for instance in instances:
+            result.append(instance_to_dict(instance, truncate=truncate))
+    return result, next_cursor
+
+
+def get_query_args(sort=None, fields=None, filters=None):
     kwargs = {}
     if sort:
         if not isinstance(sort, list):
@@ -390,14 +430,7 @@ def ilist_get(name, page=1, sort=None, fields=None, truncate=True, filters=None)
     if filters:
         if len(filters) > 0:
             kwargs["filters"] = filters
-    if name not in KNOWN_MODELS:
-        for entity in db.ilist_entities(name, limit, offset, **kwargs):
-            info = item_to_dict(entity, truncate=truncate)
-            yield info
-    else:
-        for instance in KNOWN_MODELS[name].ilist_all(limit, offset, **kwargs):
-            info = instance_to_dict(instance, truncate=truncate)
-            yield info
+    return kwargs
 
 
 def list_post(name, info):
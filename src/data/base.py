@@ -0,0 +1,530 @@
+#
+# Copyright (c) 2019-2020 Mike's Pub, see https://github.com/mikespub-org
+# Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
+#
+"""
+In-memory stand-in for google.cloud.datastore.Client, for off-line testing and
+benchmarking of data.* without a project or emulator, e.g.::
+
+    DATASTORE_CLIENT_BACKEND=base DATASTORE_BASE_LATENCY=0.005 python3 -m data.try_fs2dav
+
+or in code with db.client_manager.set_client(BaseClient()).
+
+It supports keys and ancestors, property filters (incl. And/Or), order, projection,
+keys_only, distinct_on, offset/limit and cursors, the __namespace__, __kind__ and
+__property__ metadata queries, get/put/delete(_multi) and batches/transactions.
+Transactions are applied atomically on commit, but they never fail on contention.
+Each RPC can sleep for latency seconds, and is counted in client.stats.
+"""
+
+import base64
+import datetime
+import itertools
+import threading
+import time
+
+from google.cloud import datastore
+from google.cloud._helpers import _LocalStack
+from google.cloud.datastore.helpers import GeoPoint
+from google.cloud.datastore.query import And, Or, PropertyFilter
+
+# order of the value types in the datastore indexes
+_TYPE_RANKS = (
+    (type(None), 0),
+    (bool, 2),
+    (int, 1),
+    (datetime.datetime, 1),
+    (bytes, 3),
+    (str, 4),
+    (float, 5),
+    (GeoPoint, 6),
+    (datastore.Key, 7),
+)
+_REPRESENTATIONS = (
+    (type(None), "NULL"),
+    (bool, "BOOLEAN"),
+    (int, "INT64"),
+    (datetime.datetime, "INT64"),
+    (bytes, "STRING"),
+    (str, "STRING"),
+    (float, "DOUBLE"),
+    (GeoPoint, "POINT"),
+    (datastore.Key, "REFERENCE"),
+)
+
+
+def _key_path(key):
+    # ids sort before names in the same position
+    return tuple(
+        (0, item) if isinstance(item, int) else (1, item) for item in key.flat_path
+    )
+
+
+def _store_key(key):
+    return (key.namespace, key.flat_path)
+
+
+def _sort_value(value):
+    if isinstance(value, datastore.Key):
+        return (7, _key_path(value))
+    for cls, rank in _TYPE_RANKS:
+        if isinstance(value, cls):
+            if isinstance(value, datetime.datetime):
+                if value.tzinfo is None:
+                    value = value.replace(tzinfo=datetime.timezone.utc)
+                value = value.timestamp() * 1000000
+            elif isinstance(value, GeoPoint):
+                value = (value.latitude, value.longitude)
+            return (rank, value)
+    return (8, repr(value))
+
+
+def _representation(value):
+    for cls, name in _REPRESENTATIONS:
+        if isinstance(value, cls):
+            return name
+    return "STRING"
+
+
+def copy_entity(entity):
+    """Copy the entity so changes to the stored or returned entities don't leak"""
+    result = datastore.Entity(
+        key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes)
+    )
+    for name, value in entity.items():
+        if isinstance(value, datastore.Entity):
+            value = copy_entity(value)
+        elif isinstance(value, list):
+            value = [
+                copy_entity(item) if isinstance(item, datastore.Entity) else item
+                for item in value
+            ]
+        result[name] = value
+    return result
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(b"%d" % position)
+
+
+def decode_cursor(cursor):
+    if isinstance(cursor, str):
+        cursor = cursor.encode("ascii")
+    try:
+        return int(base64.urlsafe_b64decode(cursor))
+    except ValueError:
+        raise ValueError("invalid cursor %r" % cursor)
+
+
+class BaseIterator:
+    """Results of BaseQuery.fetch() with the same interface as the datastore Iterator"""
+
+    def __init__(self, results, next_position=None):
+        self._results = results
+        self.num_results = 0
+        self.next_page_token = None
+        if next_position is not None:
+            self.next_page_token = encode_cursor(next_position)
+
+    def __iter__(self):
+        for entity in self._results:
+            self.num_results += 1
+            yield entity
+
+    @property
+    def pages(self):
+        # all results are returned in one page, like a datastore query with a limit
+        yield iter(self)
+
+
+class BaseQuery(datastore.Query):
+    def fetch(
+        self,
+        limit=None,
+        offset=0,
+        start_cursor=None,
+        end_cursor=None,
+        client=None,
+        eventual=False,
+        retry=None,
+        timeout=None,
+        read_time=None,
+    ):
+        client = client or self._client
+        client._rpc("query")
+        results = self._get_results(client)
+        # cursors are positions in the ordered results here
+        start = decode_cursor(start_cursor) if start_cursor else 0
+        stop = decode_cursor(end_cursor) if end_cursor else len(results)
+        start += offset or 0
+        if limit is not None:
+            stop = min(stop, start + limit)
+        page = [self._to_entity(entity) for entity in results[start:stop]]
+        next_position = stop if stop < len(results) else None
+        return BaseIterator(page, next_position)
+
+    def _get_results(self, client):
+        namespace = self.namespace if self.namespace is not None else client.namespace
+        if self.kind in ("__namespace__", "__kind__", "__property__"):
+            entities = client._get_metadata(self.kind, namespace)
+        else:
+            entities = client._get_entities(self.kind, namespace)
+        if self.ancestor is not None:
+            path = self.ancestor.flat_path
+            entities = [
+                entity
+                for entity in entities
+                if entity.key.flat_path[: len(path)] == path
+            ]
+        filters = list(self.filters)
+        names = [name.lstrip("-") for name in self.order] + list(self.distinct_on)
+        if self.projection and self.projection != ["__key__"]:
+            names.extend(self.projection)
+        results = [
+            entity
+            for entity in entities
+            if self._is_indexed(entity, names)
+            and all(self._match(entity, item) for item in filters)
+        ]
+        # sort by the last order first, the sort is stable
+        results.sort(key=lambda entity: _key_path(entity.key))
+        for name in reversed(list(self.order)):
+            reverse = name.startswith("-")
+            name = name.lstrip("-")
+            results.sort(
+                key=lambda entity: self._sort_key(entity, name, reverse),
+                reverse=reverse,
+            )
+        if self.distinct_on:
+            seen = set()
+            distinct = []
+            for entity in results:
+                values = tuple(_sort_value(entity[name]) for name in self.distinct_on)
+                if values not in seen:
+                    seen.add(values)
+                    distinct.append(entity)
+            results = distinct
+        return results
+
+    @staticmethod
+    def _is_indexed(entity, names):
+        # entities without the property, or with an unindexed property, are not found
+        for name in names:
+            if name == "__key__":
+                continue
+            if name not in entity or name in entity.exclude_from_indexes:
+                return False
+        return True
+
+    @staticmethod
+    def _get_values(entity, name):
+        if name == "__key__":
+            return [entity.key]
+        value = entity[name]
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    def _sort_key(self, entity, name, reverse=False):
+        # lists sort on their smallest value, or largest for a descending order
+        values = [_sort_value(value) for value in self._get_values(entity, name)]
+        if not values:
+            return (-1,)
+        return max(values) if reverse else min(values)
+
+    def _match(self, entity, item):
+        if isinstance(item, Or):
+            return any(self._match(entity, sub) for sub in item.filters)
+        if isinstance(item, And):
+            return all(self._match(entity, sub) for sub in item.filters)
+        if isinstance(item, PropertyFilter):
+            name, op, value = item.property_name, item.operator, item.value
+        else:
+            name, op, value = item
+        if not self._is_indexed(entity, [name]):
+            return False
+        values = [_sort_value(actual) for actual in self._get_values(entity, name)]
+        if op in ("IN", "NOT_IN"):
+            wanted = [_sort_value(other) for other in value]
+            if op == "IN":
+                return any(actual in wanted for actual in values)
+            return all(actual not in wanted for actual in values)
+        value = _sort_value(value)
+        if op == "=":
+            return any(actual == value for actual in values)
+        if op == "!=":
+            return any(actual != value for actual in values)
+        # inequalities only compare values of the same type
+        values = [actual for actual in values if actual[0] == value[0]]
+        if op == "<":
+            return any(actual < value for actual in values)
+        if op == "<=":
+            return any(actual <= value for actual in values)
+        if op == ">":
+            return any(actual > value for actual in values)
+        if op == ">=":
+            return any(actual >= value for actual in values)
+        raise ValueError("Unsupported filter operator %r" % op)
+
+    def _to_entity(self, entity):
+        if not self.projection:
+            return copy_entity(entity)
+        result = datastore.Entity(key=entity.key)
+        for name in self.projection:
+            if name != "__key__":
+                result[name] = entity[name]
+        return result
+
+
+class BaseBatch:
+    """Collect the puts and deletes, and apply them together on commit"""
+
+    def __init__(self, client):
+        self._client = client
+        self._puts = []
+        self._deletes = []
+        self._in_progress = False
+
+    def begin(self):
+        if self._in_progress:
+            raise ValueError("Batch already started previously.")
+        self._in_progress = True
+
+    def put(self, entity):
+        if not self._in_progress:
+            raise ValueError("Batch must be in progress to put()")
+        self._puts.append(entity)
+
+    def delete(self, key):
+        if not self._in_progress:
+            raise ValueError("Batch must be in progress to delete()")
+        if key.is_partial:
+            raise ValueError("Key must be complete")
+        self._deletes.append(key)
+
+    def commit(self, retry=None, timeout=None):
+        if not self._in_progress:
+            raise ValueError("Batch must be in progress to commit()")
+        try:
+            self._client._commit(self._puts, self._deletes)
+        finally:
+            self._in_progress = False
+
+    def rollback(self, retry=None, timeout=None):
+        self._puts = []
+        self._deletes = []
+        self._in_progress = False
+
+    def __enter__(self):
+        self.begin()
+        self._client._push_batch(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self._client._pop_batch()
+
+
+class BaseTransaction(BaseBatch):
+    _ids = itertools.count(1)
+
+    def __init__(self, client, read_only=False, **kwargs):
+        super().__init__(client)
+        self._read_only = read_only
+        self.id = None
+
+    def begin(self, retry=None, timeout=None):
+        super().begin()
+        self.id = next(self._ids)
+
+    def put(self, entity):
+        if self._read_only:
+            raise RuntimeError("Transaction is read only")
+        super().put(entity)
+
+
+class BaseClient:
+    """In-memory datastore client - clone() shares the entities with a new client"""
+
+    def __init__(self, project="base-project", namespace=None, latency=0.0):
+        self.project = project
+        self.namespace = namespace
+        self.database = None
+        # seconds to sleep for each RPC, to simulate the network
+        self.latency = latency
+        self._store = {}
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.stats = {"get": 0, "put": 0, "delete": 0, "query": 0, "commit": 0}
+        # the current batch/transaction of each thread, like in the datastore client
+        self._batch_stack = _LocalStack()
+
+    def clone(self):
+        client = object.__new__(self.__class__)
+        client.__dict__.update(self.__dict__)
+        client._batch_stack = _LocalStack()
+        return client
+
+    def _rpc(self, name):
+        with self._lock:
+            self.stats[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _push_batch(self, batch):
+        self._batch_stack.push(batch)
+
+    def _pop_batch(self):
+        return self._batch_stack.pop()
+
+    @property
+    def current_batch(self):
+        return self._batch_stack.top
+
+    @property
+    def current_transaction(self):
+        transaction = self.current_batch
+        if isinstance(transaction, BaseTransaction):
+            return transaction
+        return None
+
+    def key(self, *path_args, **kwargs):
+        kwargs.setdefault("project", self.project)
+        if self.namespace is not None:
+            kwargs.setdefault("namespace", self.namespace)
+        return datastore.Key(*path_args, **kwargs)
+
+    def query(self, **kwargs):
+        kwargs.setdefault("project", self.project)
+        if self.namespace is not None:
+            kwargs.setdefault("namespace", self.namespace)
+        return BaseQuery(self, **kwargs)
+
+    def batch(self):
+        return BaseBatch(self)
+
+    def transaction(self, **kwargs):
+        return BaseTransaction(self, **kwargs)
+
+    def allocate_ids(self, incomplete_key, num_ids, retry=None, timeout=None):
+        if not incomplete_key.is_partial:
+            raise ValueError(("Key is not partial.", incomplete_key))
+        with self._lock:
+            return [
+                incomplete_key.completed_key(next(self._ids)) for i in range(num_ids)
+            ]
+
+    def get(self, key, missing=None, deferred=None, transaction=None, **kwargs):
+        entities = self.get_multi([key], missing=missing, deferred=deferred)
+        if entities:
+            return entities[0]
+        return None
+
+    def get_multi(self, keys, missing=None, deferred=None, transaction=None, **kwargs):
+        if not keys:
+            return []
+        self._rpc("get")
+        result = []
+        with self._lock:
+            for key in keys:
+                entity = self._store.get(_store_key(key))
+                if entity is None:
+                    if missing is not None:
+                        missing.append(datastore.Entity(key=key))
+                    continue
+                result.append(copy_entity(entity))
+        return result
+
+    def put(self, entity, **kwargs):
+        self.put_multi([entity])
+
+    def put_multi(self, entities, **kwargs):
+        entities = list(entities)
+        if not entities:
+            return
+        current = self.current_batch
+        if current is not None:
+            for entity in entities:
+                current.put(entity)
+            return
+        self._commit(entities, [])
+
+    def delete(self, key, **kwargs):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys, **kwargs):
+        keys = list(keys)
+        if not keys:
+            return
+        current = self.current_batch
+        if current is not None:
+            for key in keys:
+                current.delete(key)
+            return
+        self._commit([], keys)
+
+    def _commit(self, puts, deletes):
+        if puts and deletes:
+            self._rpc("commit")
+        elif puts:
+            self._rpc("put")
+        elif deletes:
+            self._rpc("delete")
+        with self._lock:
+            for entity in puts:
+                if entity.key is None:
+                    raise ValueError("Entity must have a key")
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(next(self._ids))
+                self._store[_store_key(entity.key)] = copy_entity(entity)
+            for key in deletes:
+                self._store.pop(_store_key(key), None)
+
+    def _get_entities(self, kind, namespace=None):
+        with self._lock:
+            return [
+                entity
+                for (entity_namespace, path), entity in self._store.items()
+                if entity_namespace == namespace and (kind is None or path[-2] == kind)
+            ]
+
+    def _get_metadata(self, kind, namespace=None):
+        with self._lock:
+            entities = list(self._store.values())
+        result = {}
+        if kind == "__namespace__":
+            for entity in entities:
+                name = entity.key.namespace
+                # the default namespace has id 1
+                key = self.key("__namespace__", name or 1, namespace=None)
+                result[_store_key(key)] = datastore.Entity(key=key)
+            return list(result.values())
+        for entity in entities:
+            if entity.key.namespace != namespace:
+                continue
+            key = self.key("__kind__", entity.key.kind, namespace=namespace)
+            if kind == "__kind__":
+                result.setdefault(_store_key(key), datastore.Entity(key=key))
+                continue
+            for name, value in entity.items():
+                if name in entity.exclude_from_indexes:
+                    continue
+                prop_key = self.key("__property__", name, parent=key)
+                prop = result.setdefault(
+                    _store_key(prop_key), datastore.Entity(key=prop_key)
+                )
+                representations = prop.setdefault("property_representation", [])
+                values = value if isinstance(value, list) else [value]
+                for item in values:
+                    representation = _representation(item)
+                    if representation not in representations:
+                        representations.append(representation)
+        return list(result.values())
+
+    def close(self):
+        pass
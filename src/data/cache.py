@@ -8,8 +8,14 @@
 """
 Implement cache mechanism.
 """
+import atexit
 import logging
+import os
+import pickle
 import threading
+import time
+from collections import OrderedDict, defaultdict
+from time import perf_counter
 
 from cachelib import MemcachedCache, SimpleCache
 
@@ -20,31 +26,75 @@ except Exception as e:
     logging.info(e)
     memcache3 = SimpleCache()
 
-memcache3._stats = {
-    "byte_hits": 0,
-    "bytes": 0,
-    "hits": 0,
-    "items": 0,
-    "misses": 0,
-    "oldest_item_age": 0,
-    # keep track of operations other than get (= hits + misses)
-    "set": 0,
-    "set_multi": 0,
-    "delete": 0,
-    "get_list": 0,
-    "set_list": 0,
-    "del_list": 0,
-}
+# add the cache statistics of each process to the shared ones every 10 seconds, from
+# a background thread (and at exit)
+STATS_FLUSH_INTERVAL = 10
+# with the time spent in memcache3 calls counted per bucket of at most x ms
+STATS_TIMING_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# keep recent items in a local cache per process for the namespaces that ask for it,
+# unless memcache3 is a SimpleCache already
+USE_LOCAL_CACHE = not isinstance(memcache3, SimpleCache)
+# with at most 16M of (pickled) items per namespace
+LOCAL_CACHE_BYTES = 16 * 1024 * 1024
+# for at most 30 seconds per item
+LOCAL_CACHE_TIMEOUT = 30
+# and check if another process invalidated something at most once per second
+LOCAL_CACHE_CHECK_INTERVAL = 1.0
+# by replaying the keys they invalidated since the last check, unless that's more than
+# 200 invalidations ago (or the log expired) - then the local cache is cleared instead
+LOCAL_CACHE_MAX_LOG = 200
+local_caches = []
 
 
 def memcache_reset(mycache=memcache3):
-    for key in list(mycache._stats.keys()):
-        mycache._stats[key] = 0
+    cache_stats.reset()
+    for local in local_caches:
+        local.clear()
     return mycache.clear()
 
 
 def memcache_get_stats(mycache=memcache3):
-    return mycache._stats
+    return cache_stats.get_stats()
+
+
+def memcache_incr(key, delta=1, mycache=memcache3):
+    """
+    Increment an existing counter atomically and return the new value, or None if the
+    counter doesn't exist (anymore) - the inc() of cachelib does a get and set instead.
+    """
+    if isinstance(mycache, MemcachedCache):
+        with mycache._client_context() as client:
+            try:
+                return client.incr(mycache._normalize_key(key), delta)
+            except Exception:
+                # pylibmc raises NotFound for missing keys
+                return None
+    if mycache.get(key) is None:
+        return None
+    return mycache.inc(key, delta)
+
+
+def memcache_add_counter(key, delta, mycache=memcache3):
+    """
+    Add delta to a counter atomically, creating it if it doesn't exist yet.
+    """
+    if memcache_incr(key, delta, mycache) is None:
+        if not mycache.add(key, delta):
+            # another process created it in the meantime
+            memcache_incr(key, delta, mycache)
+
+
+def memcache_init_counter(key, mycache=memcache3):
+    """
+    Return the counter, or initialize it with a time-based value if it doesn't exist
+    - so a counter that was evicted never goes back to a value used before.
+    """
+    value = mycache.get(key)
+    if value is None:
+        mycache.add(key, time.time_ns() // 1000)
+        value = mycache.get(key)
+    return value
 
 
 memcache3.reset = memcache_reset
@@ -169,11 +219,252 @@ CACHED_NONE = "{cached-none}"
 #        return memcache.delete(key, namespace=self.namespace)
 
 
+# ===============================================================================
+# CacheStats
+# ===============================================================================
+class CacheStats:
+    """
+    Cache statistics per namespace. Each thread updates its own counters without any
+    locking, and they are only added up when reading them.
+
+    The counters of each process are also added to shared counters in memcache3 every
+    STATS_FLUSH_INTERVAL seconds by a background thread, so the totals include all
+    processes.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # (thread, counters) of the live threads, and the sum for the finished ones
+        self._threads = []
+        self._base = defaultdict(int)
+        self._flushed = {}
+        self._flusher = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self._flush_at_exit)
+
+    def _get_counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = defaultdict(int)
+            with self._lock:
+                self._collect_threads()
+                self._threads.append((threading.current_thread(), counters))
+            return counters
+
+    def _collect_threads(self):
+        # add the counters of finished threads to the base, so they don't pile up
+        alive = []
+        for thread, counters in self._threads:
+            if thread.is_alive():
+                alive.append((thread, counters))
+                continue
+            for key, value in counters.items():
+                self._base[key] += value
+        self._threads = alive
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._run_flusher, name="cache-stats", daemon=True
+            )
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(STATS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.info("CacheStats.flush: %s" % e)
+
+    def _after_fork(self):
+        # the parent process flushes its own counters, and the flusher is gone here
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        current = threading.current_thread()
+        for thread, counters in self._threads:
+            counters.clear()
+        self._threads = [item for item in self._threads if item[0] is current]
+        self._base = defaultdict(int)
+        self._flushed = {}
+        self._flusher = None
+
+    def _flush_at_exit(self):
+        if self._flusher is None:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            logging.info("CacheStats.flush: %s" % e)
+
+    def incr(self, namespace, name, delta=1):
+        self._get_counters()[(namespace, name)] += delta
+        if self._flusher is None:
+            self._start_flusher()
+
+    def timing(self, namespace, name, seconds):
+        """Count the time spent in a memcache3 call in its histogram bucket."""
+        ms = seconds * 1000
+        for limit in STATS_TIMING_BUCKETS:
+            if ms <= limit:
+                break
+        else:
+            limit = "inf"
+        counters = self._get_counters()
+        counters[(namespace, f"{name}_count")] += 1
+        counters[(namespace, f"{name}_ms_le_{limit}")] += 1
+        if self._flusher is None:
+            self._start_flusher()
+
+    def get_counters(self):
+        """Return the counters of this process as {(namespace, name): value}."""
+        with self._lock:
+            self._collect_threads()
+            result = defaultdict(int, self._base)
+            threads = list(self._threads)
+        for thread, counters in threads:
+            for key, value in counters.copy().items():
+                result[key] += value
+        return result
+
+    def flush(self):
+        """Add the counters of this process to the shared ones since the last flush."""
+        with self._flush_lock:
+            counters = self.get_counters()
+            names = set(memcache3.get("stats:names") or [])
+            for key, value in counters.items():
+                delta = value - self._flushed.get(key, 0)
+                if delta:
+                    memcache_add_counter("stats:%s:%s" % key, delta)
+                self._flushed[key] = value
+            if not names.issuperset(counters):
+                memcache3.set("stats:names", list(names.union(counters)))
+
+    def get_totals(self):
+        """Return the shared counters of all processes as {(namespace, name): value}."""
+        self.flush()
+        names = memcache3.get("stats:names") or []
+        values = memcache3.get_many(*["stats:%s:%s" % key for key in names])
+        return {key: value for key, value in zip(names, values) if value is not None}
+
+    def get_stats(self):
+        """Return the counters of this process and the totals, grouped by namespace."""
+        result = {
+            "timestamp": time.time(),
+            "process": {},
+            "total": {},
+            "local": {},
+        }
+        for what, counters in (
+            ("process", self.get_counters()),
+            ("total", self.get_totals()),
+        ):
+            for (namespace, name), value in sorted(counters.items()):
+                result[what].setdefault(str(namespace), {})[name] = value
+        for local in local_caches:
+            result["local"][str(local.namespace)] = {
+                "items": len(local._items),
+                "bytes": local._bytes,
+                "max_bytes": local.max_bytes,
+            }
+        return result
+
+    def reset(self):
+        with self._flush_lock, self._lock:
+            for thread, counters in self._threads:
+                counters.clear()
+            self._base = defaultdict(int)
+            self._flushed = {}
+        memcache3.delete("stats:names")
+
+
+cache_stats = CacheStats()
+
+
+# ===============================================================================
+# LocalCache
+# ===============================================================================
+class LocalCache:
+    """
+    Bounded in-process LRU cache with a timeout per entry, used in front of memcache3.
+
+    Values are kept pickled like in the shared cache, so each get returns a new copy
+    and the size of the cache can be limited in bytes.
+    """
+
+    def __init__(self, namespace=None, max_bytes=None, timeout=None):
+        self.namespace = namespace
+        self.max_bytes = max_bytes or LOCAL_CACHE_BYTES
+        self.timeout = timeout or LOCAL_CACHE_TIMEOUT
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        local_caches.append(self)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] < time.monotonic():
+                self._remove(key)
+                item = None
+            if item is not None:
+                self._items.move_to_end(key)
+        if item is None:
+            cache_stats.incr(self.namespace, "local_misses")
+            return None
+        cache_stats.incr(self.namespace, "local_hits")
+        cache_stats.incr(self.namespace, "local_byte_hits", len(item[1]))
+        return pickle.loads(item[1])
+
+    def set(self, key, value, timeout=0):
+        if timeout <= 0 or timeout > self.timeout:
+            timeout = self.timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        evictions = 0
+        with self._lock:
+            self._remove(key)
+            if len(data) > self.max_bytes:
+                return
+            self._items[key] = (time.monotonic() + timeout, data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._items))
+                self._remove(oldest)
+                evictions += 1
+        if evictions:
+            cache_stats.incr(self.namespace, "local_evictions", evictions)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item[1])
+
+
 # ===============================================================================
 # NamespacedCache
 # ===============================================================================
 class NamespacedCache:
-    def __init__(self, namespace):
+    def __init__(self, namespace, use_local=False):
         if hasattr(threading, "get_ident"):
             id = threading.get_ident()
         else:
@@ -181,6 +472,14 @@ class NamespacedCache:
         logging.debug("NamespacedCache.__init__, thread=%s", id)
         self.namespace = namespace
         self.stop_cache = False
+        # incremented on each delete, so request caches know they may be stale
+        self.generation = 0
+        # keep recent items in a local cache too, if memcache3 is not local already
+        self.local = None
+        if use_local and USE_LOCAL_CACHE:
+            self.local = LocalCache(namespace)
+        self._version = None
+        self._version_checked = 0
         return
 
     def __del__(self):
@@ -195,16 +494,71 @@ class NamespacedCache:
             key = f"{self.namespace}:{key}"
         return key
 
+    def _check_version(self):
+        """
+        Drop the items that other processes invalidated from the local cache - we
+        check the version in memcache3 at most once per interval, and replay the
+        keys logged for each version since the last check (see _bump_version).
+        """
+        now = time.monotonic()
+        if now - self._version_checked < LOCAL_CACHE_CHECK_INTERVAL:
+            return
+        self._version_checked = now
+        key = "version:" + self._add_namespace("")
+        version = memcache3.get(key)
+        if version == self._version:
+            return
+        logs = None
+        if (
+            version is not None
+            and self._version is not None
+            and 0 < version - self._version <= LOCAL_CACHE_MAX_LOG
+        ):
+            logs = memcache3.get_many(
+                *["%s:%d" % (key, v) for v in range(self._version + 1, version + 1)]
+            )
+        if logs is None or any(keys is None for keys in logs):
+            # too far behind, or some log entries expired (or aren't set yet)
+            self.local.clear()
+        else:
+            self.local.delete_many([item for keys in logs for item in keys])
+        self._version = version
+
+    def _bump_version(self, keys):
+        """
+        Tell the other processes to drop these keys from their local cache.
+        """
+        key = "version:" + self._add_namespace("")
+        version = memcache_incr(key)
+        if version is None:
+            version = memcache_init_counter(key)
+        # the local items don't live longer than this anyway
+        memcache3.set("%s:%d" % (key, version), keys, timeout=LOCAL_CACHE_TIMEOUT * 2)
+
+    def _local_get(self, key):
+        if self.local is None:
+            return None
+        self._check_version()
+        return self.local.get(key)
+
     def get(self, key):
         if self.stop_cache:
             return
         key = self._add_namespace(key)
+        result = self._local_get(key)
+        if result is not None:
+            logging.debug(f"Local cache HIT: {self.namespace!r}.{key!r}")
+            return result
+        start = perf_counter()
         result = memcache3.get(key)
+        cache_stats.timing(self.namespace, "get", perf_counter() - start)
         if result is not None:
-            memcache3._stats["hits"] += 1
+            cache_stats.incr(self.namespace, "hits")
             logging.debug(f"Cache HIT: {self.namespace!r}.{key!r}")
+            if self.local is not None:
+                self.local.set(key, result)
         else:
-            memcache3._stats["misses"] += 1
+            cache_stats.incr(self.namespace, "misses")
             logging.debug(f"Cache MISS: {self.namespace!r}.{key!r}")
         return result
 
@@ -213,8 +567,16 @@ class NamespacedCache:
             return
         logging.debug(f"Cache add: {self.namespace!r}.{key!r} = {value!r}")
         key = self._add_namespace(key)
-        memcache3._stats["set"] += 1
-        return memcache3.set(key, value, timeout=time)
+        cache_stats.incr(self.namespace, "set")
+        if self.local is not None:
+            self.local.set(key, value, time)
+        start = perf_counter()
+        result = memcache3.set(key, value, timeout=time)
+        cache_stats.timing(self.namespace, "set", perf_counter() - start)
+        if self.local is not None:
+            # the other processes may still have the old value in their local cache
+            self._bump_version([key])
+        return result
 
     def set_multi(self, mapping, time=0, key_prefix=""):
         if self.stop_cache:
@@ -226,46 +588,225 @@ class NamespacedCache:
                 key = key_prefix + key
             key = self._add_namespace(key)
             new_mapping[key] = value
-        memcache3._stats["set_multi"] += 1
+            if self.local is not None:
+                self.local.set(key, value, time)
+        cache_stats.incr(self.namespace, "set_multi")
         # this returns True on success or False on failure, but set_multi expects a list of failed keys back
         result = memcache3.set_many(new_mapping, timeout=time)
+        if self.local is not None:
+            self._bump_version(list(new_mapping))
         if result:
             return []
         return ["failed"]
 
     def delete(self, key):
+        self.generation += 1
         if self.stop_cache:
             return
         logging.debug(f"Cache delete: {self.namespace!r}.{key!r}")
         key = self._add_namespace(key)
-        memcache3._stats["delete"] += 1
-        return memcache3.delete(key)
+        cache_stats.incr(self.namespace, "delete")
+        if self.local is not None:
+            self.local.delete(key)
+        result = memcache3.delete(key)
+        if self.local is not None:
+            # after the delete, so the other processes don't get the old value again
+            self._bump_version([key])
+        return result
 
-    def get_list(self, key):
+    def delete_multi(self, keys):
+        self.generation += 1
         if self.stop_cache:
             return
-        key = "list:" + self._add_namespace(key)
-        memcache3._stats["get_list"] += 1
+        logging.debug(f"Cache delete multi: {self.namespace!r}.{keys!r}")
+        keys = [self._add_namespace(key) for key in keys]
+        cache_stats.incr(self.namespace, "delete", len(keys))
+        if self.local is not None:
+            self.local.delete_many(keys)
+        result = memcache3.delete_many(*keys)
+        if self.local is not None:
+            self._bump_version(keys)
+        return result
+
+    def get_list_version(self, key):
+        """
+        Return the current generation of the list for key - this is part of the cache
+        key of the list, and del_list() increments it instead of deleting the list.
+
+        Get it before fetching the list, and pass it to set_list() afterwards: if the
+        list changed in the meantime, it will be saved under the old generation.
+        """
+        if self.stop_cache:
+            return 0
+        key = "gen:" + self._add_namespace(key)
+        result = self._local_get(key)
+        if result is not None:
+            return result
+        result = memcache_init_counter(key)
+        if self.local is not None:
+            self.local.set(key, result)
+        return result
+
+    def _list_key(self, key, version, prefix="list"):
+        # other lists for the same key (e.g. "paths" for the names only) get their own
+        # prefix, and share the generation counter
+        return f"{prefix}:{self._add_namespace(key)}#{version}"
+
+    def get_list(self, key, version=None, prefix="list"):
+        if self.stop_cache:
+            return
+        if version is None:
+            version = self.get_list_version(key)
+        key = self._list_key(key, version, prefix)
+        cache_stats.incr(self.namespace, "get_list")
+        result = self._local_get(key)
+        if result is not None:
+            return result
+        start = perf_counter()
         result = memcache3.get(key)
+        cache_stats.timing(self.namespace, "get", perf_counter() - start)
         if result is not None:
-            memcache3._stats["hits"] += len(result)
+            cache_stats.incr(self.namespace, "hits", len(result))
+            if self.local is not None:
+                self.local.set(key, result)
         return result
 
-    def set_list(self, key, value, time=0):
+    def set_list(self, key, value, time=0, version=None, prefix="list"):
         if self.stop_cache:
             return
-        key = "list:" + self._add_namespace(key)
-        memcache3._stats["set_list"] += 1
+        if version is None:
+            version = self.get_list_version(key)
+        key = self._list_key(key, version, prefix)
+        cache_stats.incr(self.namespace, "set_list")
         if value is not None:
-            memcache3._stats["misses"] += len(value)
-        return memcache3.set(key, value, timeout=time)
+            cache_stats.incr(self.namespace, "misses", len(value))
+        if self.local is not None:
+            self.local.set(key, value, time)
+        start = perf_counter()
+        result = memcache3.set(key, value, timeout=time)
+        cache_stats.timing(self.namespace, "set", perf_counter() - start)
+        return result
 
     def del_list(self, key):
+        return self.del_list_multi([key])
+
+    def del_list_multi(self, keys):
+        self.generation += 1
+        if self.stop_cache:
+            return
+        keys = ["gen:" + self._add_namespace(key) for key in keys]
+        cache_stats.incr(self.namespace, "del_list", len(keys))
+        # increment the generation instead of deleting the list, so readers that
+        # started before this can only save their list under the old generation
+        for key in keys:
+            memcache_incr(key)
+        if self.local is not None:
+            self.local.delete_many(keys)
+            self._bump_version(keys)
+        return
+
+
+# ===============================================================================
+# RequestCache
+# ===============================================================================
+class RequestCache:
+    """
+    Request-local cache in front of a NamespacedCache, kept in the WSGI environ.
+
+    This avoids going back to memcache for the same keys within one request, and
+    it is cleared as soon as anything is deleted from the NamespacedCache.
+    """
+
+    environ_key = "datastore.request_cache"
+
+    def __init__(self, cache, environ):
+        self.cache = cache
+        self.namespace = cache.namespace
+        caches = environ.setdefault(self.environ_key, {})
+        if self.namespace not in caches:
+            caches[self.namespace] = {"generation": cache.generation, "items": {}}
+        self._local = caches[self.namespace]
+
+    @property
+    def stop_cache(self):
+        return self.cache.stop_cache
+
+    def _get_items(self):
+        if self._local["generation"] != self.cache.generation:
+            self._local["generation"] = self.cache.generation
+            self._local["items"] = {}
+        return self._local["items"]
+
+    def get(self, key):
+        if self.stop_cache:
+            return
+        items = self._get_items()
+        if key in items:
+            logging.debug(f"Request cache hit: {self.namespace!r}.{key!r}")
+            return items[key]
+        result = self.cache.get(key)
+        if result is not None:
+            items[key] = result
+        return result
+
+    def set(self, key, value, time=0):
+        if self.stop_cache:
+            return
+        self._get_items()[key] = value
+        return self.cache.set(key, value, time=time)
+
+    def set_multi(self, mapping, time=0, key_prefix=""):
+        if self.stop_cache:
+            return []
+        items = self._get_items()
+        for key, value in mapping.items():
+            items[key_prefix + key] = value
+        return self.cache.set_multi(mapping, time=time, key_prefix=key_prefix)
+
+    def set_local_multi(self, mapping):
+        """Only cache these items for the rest of the request."""
+        if self.stop_cache:
+            return
+        self._get_items().update(mapping)
+
+    def delete(self, key):
+        return self.cache.delete(key)
+
+    def delete_multi(self, keys):
+        return self.cache.delete_multi(keys)
+
+    def get_list_version(self, key):
+        if self.stop_cache:
+            return 0
+        items = self._get_items()
+        if "gen:" + key not in items:
+            items["gen:" + key] = self.cache.get_list_version(key)
+        return items["gen:" + key]
+
+    def get_list(self, key, version=None, prefix="list"):
+        if self.stop_cache:
+            return
+        items = self._get_items()
+        if prefix + ":" + key in items:
+            return items[prefix + ":" + key]
+        result = self.cache.get_list(key, version, prefix)
+        if result is not None:
+            items[prefix + ":" + key] = result
+        return result
+
+    def set_list(self, key, value, time=0, version=None, prefix="list"):
         if self.stop_cache:
             return
-        key = "list:" + self._add_namespace(key)
-        memcache3._stats["del_list"] += 1
-        return memcache3.delete(key)
+        self._get_items()[prefix + ":" + key] = value
+        return self.cache.set_list(
+            key, value, time=time, version=version, prefix=prefix
+        )
+
+    def del_list(self, key):
+        return self.cache.del_list(key)
+
+    def del_list_multi(self, keys):
+        return self.cache.del_list_multi(keys)
 
 
 # ===============================================================================
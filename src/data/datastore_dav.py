@@ -51,7 +51,8 @@ class DatastoreDAVResource(_DAVResource):
             self.path_entity = path
             path = self.path_entity.path
         else:
-            self.path_entity = Path.retrieve(path)
+            # lookups are cached in environ for the rest of the request
+            self.path_entity = Path.retrieve(path, environ)
         if not self.path_entity:
             raise ValueError("Path not found: %r" % path)
         is_collection = type(self.path_entity) is Dir
@@ -62,6 +63,8 @@ class DatastoreDAVResource(_DAVResource):
         self.statresults = data_fs.stat(self.path_entity)
         self._etag = None
         self._content_type = None
+        # the BtWriter returned by begin_write(), to abort in end_write()
+        self._writer = None
         # TODO: fill self._data with some properties from self.path_entity?
         self._data = {}
 
@@ -104,6 +107,13 @@ class DatastoreDAVResource(_DAVResource):
             return None
         return self.statresults.st_size
 
+    def get_used_bytes(self):
+        if not self.is_collection:
+            return None
+        # total size of the files in the whole subtree, or None for older directories
+        # until their aggregates are rebuilt offline
+        return self.path_entity.get_aggregates()[1]
+
     def get_content_type(self):
         if self.is_collection:
             # TODO: should be None?
@@ -157,7 +167,7 @@ class DatastoreDAVResource(_DAVResource):
         See _DAVResource.get_member_list()
         """
         # self._check_browse_access()
-        return data_fs.listdir(self.path_entity)
+        return data_fs.listdir(self.path_entity, self.environ)
 
     def get_member(self, name):
         """Return list of (direct) collection members (_DAVResource or derived).
@@ -175,7 +185,7 @@ class DatastoreDAVResource(_DAVResource):
         if not self.is_collection:
             raise NotImplementedError
         memberList = []
-        for entity in data_fs.scandir(self.path_entity):
+        for entity in data_fs.scandir(self.path_entity, self.environ):
             # member = DatastoreDAVResource(entity, self.environ)
             member = type(self)(entity, self.environ)
             assert member is not None
@@ -224,6 +234,7 @@ class DatastoreDAVResource(_DAVResource):
         assert not self.is_collection
         self._check_read_access()
         # return data_fs.btopen(self.path, "rb")
+        # this returns a BtReader, so range requests only fetch the chunks they need
         return data_fs.btopen(self.path_entity, "rb")
 
     def begin_write(self, *, content_type=None):
@@ -234,7 +245,19 @@ class DatastoreDAVResource(_DAVResource):
         assert not self.is_collection
         self._check_write_access()
         # return data_fs.btopen(self.path, "wb")
-        return data_fs.btopen(self.path_entity, "wb")
+        self._writer = data_fs.btopen(self.path_entity, "wb")
+        return self._writer
+
+    def end_write(self, *, with_errors):
+        """Called when PUT has finished writing.
+
+        See _DAVResource.end_write()
+        """
+        writer = self._writer
+        self._writer = None
+        if with_errors and writer is not None:
+            # the body copy failed - don't replace the old content with a partial one
+            writer.abort()
 
     def support_recursive_delete(self):
         """Return True, if delete() may be called on non-empty collections
@@ -243,8 +266,7 @@ class DatastoreDAVResource(_DAVResource):
         This method MUST be implemented for collections (not called on
         non-collections).
         """
-        # TODO: should support recursive operations
-        return False
+        return True
 
     def delete(self):
         """Remove this resource or collection (recursive).
@@ -267,7 +289,7 @@ class DatastoreDAVResource(_DAVResource):
         self._check_write_access()
         if self.is_collection:
             # Create destination collection, if not exists
-            if not data_fs.exists(dest_path):
+            if not data_fs.exists(dest_path, self.environ):
                 data_fs.mkdir(dest_path)
         else:
             # Copy file (overwrite, if exists)
@@ -288,24 +310,22 @@ class DatastoreDAVResource(_DAVResource):
 
     def support_recursive_move(self, dest_path):
         """Return True, if move_recursive() is available (see comments there)."""
-        # TODO: should support recursive operations
-        return False
+        return True
 
-    # def move_recursive(self, dest_path):
-    #     """See _DAVResource.move_recursive() """
-    #     # FIXME
-    #     raise NotImplementedError()
-    #     fpDest = self.provider._locToFilePath(dest_path)
-    #     assert not util.is_equal_or_child_uri(self.path, dest_path)
-    #     assert not os.path.exists(fpDest)
-    #     _logger.debug("moveRecursive(%s, %s)" % (self._file_path, fpDest))
-    #     shutil.move(self._file_path, fpDest)
-    #     # (Live properties are copied by copy2 or copystat)
-    #     # Move dead properties
-    #     if self.provider.prop_manager:
-    #         dest_res = self.provider.get_resource_inst(dest_path, self.environ)
-    #         self.provider.prop_manager.move_properties(self.get_ref_url(), dest_res.get_ref_url(),
-    #                                                    with_children=True)
+    def move_recursive(self, dest_path):
+        """See _DAVResource.move_recursive()"""
+        self._check_write_access()
+        assert not util.is_equal_or_child_uri(self.path, dest_path)
+        assert not data_fs.exists(dest_path, self.environ)
+        logging.debug(f"move_recursive({self.path!r}, {dest_path!r})")
+        # only the path entities are rewritten here, not the chunks
+        data_fs.rename(self.path_entity, dest_path)
+        # Move dead properties
+        if self.provider.prop_manager:
+            dest_res = self.provider.get_resource_inst(dest_path, self.environ)
+            self.provider.prop_manager.move_properties(
+                self.get_ref_url(), dest_res.get_ref_url(), with_children=True
+            )
 
     def get_property_names(self, is_allprop):
         """Return list of supported property names in Clark Notation.
@@ -58,6 +58,8 @@ __all__ = ["DatastoreDB", "WrapDatastoreDB"]
 
 
 log = logging.getLogger(__name__)
+# number of page cursors to remember for listdir() and scandir()
+MAX_CURSORS = 100
 
 
 class DatastoreDB(FS):
@@ -76,6 +78,8 @@ class DatastoreDB(FS):
         # self._meta = {}
         super().__init__()
         self._limit = limit
+        # cursors where the previous pages ended, by (kind, keys_only, offset)
+        self._cursors = {}
         # Initialize Datastore database if needed
         # db.initdb(self)
         self._namespaces = db.list_namespaces()
@@ -154,7 +158,7 @@ class DatastoreDB(FS):
             limit = self._limit
         # return [str(key.id_or_name) for key in db.list_entity_keys(kind, limit, offset)]
         result = []
-        for key in db.list_entity_keys(kind, limit, offset):
+        for key in self._get_page(kind, limit, offset, keys_only=True):
             name = self._key_to_path(key)
             result.append(name)
         return result
@@ -349,8 +353,11 @@ class DatastoreDB(FS):
         # iter_info = self._scandir_from_resource(_res, namespaces)
         if page is not None:
             start, end = page
-            iter_info = self._scandir_from_resource(
-                _res, namespaces, end - start, start
+            iter_info = (
+                self._make_info_from_resource(
+                    db.make_instance(_res._kind, entity), namespaces
+                )
+                for entity in self._get_page(_res._kind, end - start, start)
             )
         else:
             limit = self._limit
@@ -567,6 +574,28 @@ class DatastoreDB(FS):
         for _child_res in _res.iget_content():
             yield cls._make_info_from_resource(_child_res, namespaces)
 
+    def _get_page(self, kind, limit, offset=0, keys_only=False):
+        """Get a page of entities (or keys) of kind, continuing from the cursor
+        where the previous page ended if we have one - so paging through a kind
+        with consecutive (start, end) pages doesn't get slower for deep pages.
+        """
+        cursor = None
+        if offset:
+            cursor = self._cursors.pop((kind, keys_only, offset), None)
+        if keys_only:
+            page_func = db.list_entity_keys_page
+        else:
+            page_func = db.list_entities_page
+        if cursor:
+            result, next_cursor = page_func(kind, limit, cursor)
+        else:
+            result, next_cursor = page_func(kind, limit, offset=offset)
+        if next_cursor and len(result) > 0:
+            self._cursors[(kind, keys_only, offset + len(result))] = next_cursor
+            while len(self._cursors) > MAX_CURSORS:
+                del self._cursors[next(iter(self._cursors))]
+        return result
+
     @staticmethod
     def _key_to_path(key):
         if key.parent is not None:
@@ -38,8 +38,8 @@ from fs.wrapfs import WrapFS
 # use the datastore fs module here
 from . import fs as data_fs
 
-# TODO: replace with more advanced IO class - see e.g. _MemoryFile in fs.memoryfs
-# from .fs import BtIO
+# TODO: replace BtIO with more advanced IO class for writing - see e.g. _MemoryFile in fs.memoryfs
+# from .fs import BtIO, BtReader
 
 #
 # Specify location of your service account credentials in environment variable before you start:
@@ -65,7 +65,7 @@ class DatastoreFS(FS):
         "invalid_path_chars": "\0",
         "network": True,
         "read_only": False,
-        "supports_rename": False,
+        "supports_rename": True,
         "thread_safe": False,
         "unicode_paths": True,
         "virtual": False,
@@ -199,12 +199,12 @@ class DatastoreFS(FS):
             if not _dir_res or not _dir_res.isdir():
                 raise errors.ResourceNotFound(path)
 
-            if dir_name in _dir_res.listdir():
+            _res = self._getresource(path)
+            if _res:
                 if not recreate:
                     raise errors.DirectoryExists(path)
 
-                _res = self._getresource(path)
-                if _res and _res.isdir():
+                if _res.isdir():
                     return self.opendir(path)
 
             _res = data_fs.mkdir(self._prep_path(_path))
@@ -254,24 +254,24 @@ class DatastoreFS(FS):
             if not _dir_res or not _dir_res.isdir():
                 raise errors.ResourceNotFound(path)
 
+            # direct lookup by key instead of listing the parent directory
+            _res = self._getresource(path)
             if _mode.create:
-                if file_name in _dir_res.listdir():
+                if _res:
                     if _mode.exclusive:
                         raise errors.FileExists(path)
 
-                    _res = self._getresource(path)
-                    if not _res or not _res.isfile():
+                    if not _res.isfile():
                         raise errors.FileExpected(path)
 
                     return self._btopen(_res, _mode.to_platform_bin())
 
                 return self._btopen(self._prep_path(_path), _mode.to_platform_bin())
 
-            if file_name not in _dir_res.listdir():
+            if not _res:
                 raise errors.ResourceNotFound(path)
 
-            _res = self._getresource(path)
-            if not _res or not _res.isfile():
+            if not _res.isfile():
                 raise errors.FileExpected(path)
 
             return self._btopen(_res, _mode.to_platform_bin())
@@ -619,9 +619,75 @@ class DatastoreFS(FS):
                 ``dst_path`` does not exist.
 
         """
-        # TODO: update parent key of chunk entities instead of copy & delete?
-        self.copy(src_path, dst_path, overwrite, preserve_time)
-        self.remove(src_path)
+        self.validatepath(src_path)
+        _dst_path = self.validatepath(dst_path)
+        with self._lock:
+            _src_res = self._getresource(src_path)
+            if not _src_res:
+                raise errors.ResourceNotFound(src_path)
+            if not _src_res.isfile():
+                raise errors.FileExpected(src_path)
+
+            _dst_res = self._getresource(dst_path)
+            if _dst_res:
+                if not overwrite:
+                    raise errors.DestinationExists(dst_path)
+                if _dst_res.key() == _src_res.key():
+                    return
+                if not _dst_res.isfile():
+                    raise errors.FileExpected(dst_path)
+                _dst_res.delete()
+
+            dir_path, file_name = split(_dst_path)
+            _dir_res = self._getresource(dir_path)
+            if not _dir_res or not _dir_res.isdir():
+                raise errors.ResourceNotFound(dst_path)
+
+            # only the file entity is rewritten here, not the chunks
+            _src_res.rename(self._prep_path(_dst_path))
+
+    def movedir(self, src_path, dst_path, create=False, preserve_time=False):
+        # type: (Text, Text, bool, bool) -> None
+        """Move directory ``src_path`` to ``dst_path``.
+
+        Arguments:
+            src_path (str): Path of source directory on the filesystem.
+            dst_path (str): Path to destination directory.
+            create (bool): If `True`, then ``dst_path`` will be created
+                if it doesn't exist already (defaults to `False`).
+
+        Raises:
+            fs.errors.ResourceNotFound: if ``dst_path`` does not exist,
+                and ``create`` is `False`.
+            fs.errors.DirectoryExpected: if ``src_path`` or one of its
+                ancestors is not a directory.
+
+        """
+        self.validatepath(src_path)
+        _dst_path = self.validatepath(dst_path)
+        with self._lock:
+            _src_res = self._getresource(src_path)
+            if not _src_res:
+                raise errors.ResourceNotFound(src_path)
+            if not _src_res.isdir():
+                raise errors.DirectoryExpected(src_path)
+
+            _dst_res = self._getresource(dst_path)
+            if _dst_res:
+                if not _dst_res.isdir():
+                    raise errors.DirectoryExpected(dst_path)
+                # merge with the existing directory, moving one item at a time
+                return super().movedir(src_path, dst_path, create, preserve_time)
+            if not create:
+                raise errors.ResourceNotFound(dst_path)
+
+            dir_path, dir_name = split(_dst_path)
+            _dir_res = self._getresource(dir_path)
+            if not _dir_res or not _dir_res.isdir():
+                raise errors.ResourceNotFound(dst_path)
+
+            # only the path entities are rewritten here, not the chunks
+            _src_res.rename(self._prep_path(_dst_path))
 
     def create(self, path, wipe=False):
         # type: (Text, bool) -> bool
@@ -859,6 +925,10 @@ class DatastoreFS(FS):
             }
             if _res.isdir():
                 info["details"]["type"] = 1
+                # number of entries, and total size of the files in the whole subtree
+                count, total_size = _res.get_aggregates()
+                info["details"]["count"] = count
+                info["details"]["total_size"] = total_size
             else:
                 info["details"]["type"] = 2
         if "stat" in namespaces:
@@ -946,10 +1016,11 @@ class DatastoreFS(FS):
 
     @staticmethod
     def _btopen(path, mode="r"):
-        """Open the file (eg. return a BtIO object)"""
+        """Open the file (eg. return a BtIO object, or a BtReader/BtWriter)"""
         stream = data_fs.btopen(path, mode)
         _mode = Mode(mode)
-        if _mode.truncate:
+        # the BtWriter already starts from an empty file
+        if _mode.truncate and stream.seekable():
             stream.seek(0)
             stream.truncate()
         if _mode.reading and _mode.writing:
@@ -5,6 +5,11 @@
 import datetime
 import logging
 import os.path
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
 # from future.utils import with_metaclass
 from google.cloud import datastore
@@ -16,27 +21,186 @@ from .cache import NamespacedCache
 
 GOOGLE_APPLICATION_CREDENTIALS = None
 
-cached_model = NamespacedCache("model")
-
-_client = None
+cached_model = NamespacedCache("model", use_local=True)
+
+# Datastore limits the number of entities per commit, and the request size to 10 MiB
+MAX_BATCH_ENTITIES = 500
+
+# how datastore clients are shared between threads: "shared" uses one client for all
+# threads, "thread" gives each thread its own client over the same gRPC channel, and
+# "pool" spreads the thread clients over CLIENT_POOL_SIZE channels. The current batch/
+# transaction of a client is kept per thread, so sharing one client is safe - "pool"
+# only helps when many concurrent calls queue up on a single HTTP/2 connection.
+CLIENT_MODE = "shared"
+CLIENT_POOL_SIZE = 4
+# "datastore" for the real client, or "base" for the in-memory data.base.BaseClient to
+# test and benchmark off-line, with BASE_LATENCY seconds of simulated latency per RPC
+CLIENT_BACKEND = os.environ.get("DATASTORE_CLIENT_BACKEND", "datastore")
+BASE_LATENCY = float(os.environ.get("DATASTORE_BASE_LATENCY", "0"))
+# keep idle connections alive, and allow messages with several 800 KB chunks
+GRPC_OPTIONS = (
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.max_send_message_length", 32 * 1024 * 1024),
+    ("grpc.max_receive_message_length", 32 * 1024 * 1024),
+)
+
+
+def make_datastore_api(client, options=GRPC_OPTIONS):
+    """Create the gRPC Datastore API for client with our channel options - this is the
+    same as google.cloud.datastore._gapic.make_datastore_api() with extra options"""
+    try:
+        from google.cloud._helpers import make_secure_channel
+        from google.cloud._http import DEFAULT_USER_AGENT
+        from google.cloud.datastore_v1.services.datastore import (
+            client as datastore_client,
+        )
+        from google.cloud.datastore_v1.services.datastore.transports import grpc
+    except ImportError:
+        return None
+    if not getattr(client, "_use_grpc", False):
+        return None
+    parse_result = urlparse(client._base_url)
+    # leave the emulator to the client
+    if parse_result.scheme != "https":
+        return None
+    channel = make_secure_channel(
+        client._credentials,
+        DEFAULT_USER_AGENT,
+        parse_result.netloc,
+        extra_options=tuple(options),
+    )
+    transport = grpc.DatastoreGrpcTransport(channel=channel)
+    return datastore_client.DatastoreClient(
+        transport=transport, client_info=client._client_info
+    )
+
+
+class ClientManager:
+    """Hand out datastore clients to threads, re-using the same gRPC channels"""
+
+    def __init__(self, mode=CLIENT_MODE, pool_size=CLIENT_POOL_SIZE):
+        self.mode = mode
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # incremented by close() to invalidate the thread clients
+        self._generation = 0
+        self._client = None
+        self._apis = []
+        self._count = 0
+
+    def get_client(self, project_id=None, cred_file=GOOGLE_APPLICATION_CREDENTIALS):
+        entry = getattr(self._local, "entry", None)
+        if entry is not None and entry[0] == self._generation:
+            return entry[1]
+        with self._lock:
+            if self._client is None:
+                self._client = self.make_client(project_id, cred_file)
+                api = self._get_api(self._client)
+                if api is not None:
+                    self._client._datastore_api_internal = api
+            if self.mode == "shared":
+                client = self._client
+            else:
+                client = self.clone_client(self._client)
+            self._local.entry = (self._generation, client)
+        return client
+
+    def set_client(self, client):
+        """Use this client for all threads, e.g. for testing"""
+        with self._lock:
+            self._generation += 1
+            self.mode = "shared"
+            self._client = client
+            self._apis = []
+
+    @contextmanager
+    def use_client(self, client):
+        """Use this client for all threads within the with block, e.g. for testing"""
+        with self._lock:
+            previous = (self.mode, self._client, self._apis)
+        self.set_client(client)
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._generation += 1
+                self.mode, self._client, self._apis = previous
+
+    def make_client(self, project_id=None, cred_file=GOOGLE_APPLICATION_CREDENTIALS):
+        if CLIENT_BACKEND == "base":
+            from .base import BaseClient
+
+            return BaseClient(project_id or "base-project", latency=BASE_LATENCY)
+        if cred_file and os.path.isfile(cred_file):
+            return datastore.Client.from_service_account_json(cred_file)
+        return datastore.Client(project_id)
+
+    def clone_client(self, base):
+        """Make a new client with the same settings, sharing one of the gRPC APIs"""
+        if not isinstance(base, datastore.Client):
+            # e.g. data.base.BaseClient, with the same entities
+            return base.clone()
+        client = datastore.Client(
+            project=base.project,
+            namespace=base.namespace,
+            credentials=base._credentials,
+            database=base.database,
+        )
+        api = self._get_api(base)
+        if api is not None:
+            client._datastore_api_internal = api
+        return client
+
+    def _get_api(self, base):
+        # one channel for "thread", and round-robin over the pool for "pool"
+        size = self.pool_size if self.mode == "pool" else 1
+        if len(self._apis) < size:
+            api = make_datastore_api(base)
+            if api is None:
+                return None
+            self._apis.append(api)
+            return api
+        self._count += 1
+        return self._apis[self._count % size]
+
+    def close(self):
+        with self._lock:
+            self._generation += 1
+            self._client = None
+            # the channels are closed when the last client using them is gone
+            self._apis = []
+
+
+client_manager = ClientManager()
 
 
 def get_client(project_id=None, cred_file=GOOGLE_APPLICATION_CREDENTIALS):
-    global _client
-    if _client is not None:
-        return _client
-    if cred_file and os.path.isfile(cred_file):
-        _client = datastore.Client.from_service_account_json(cred_file)
-    else:
-        _client = datastore.Client(project_id)
-    return _client
+    return client_manager.get_client(project_id, cred_file)
 
 
 def close():
-    global _client
-    if _client is not None:
-        # _client.close()
-        _client = None
+    client_manager.close()
+
+
+# bounded thread pool shared by all concurrent datastore requests (e.g. read-ahead)
+MAX_WORKERS = 8
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is not None:
+        return _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="datastore"
+            )
+    return _executor
 
 
 def make_entity(key, exclude_from_indexes=None, **kwargs):
@@ -78,10 +242,79 @@ def get_entity_by_id(kind, id_or_name, **kwargs):
     return entity
 
 
+def iget_entities(keys, read_ahead=4):
+    """Get entities by key in order, with up to read_ahead requests in flight.
+
+    Yields the entity for each key, or None if it doesn't exist.
+    """
+    if read_ahead < 2 or len(keys) < 2:
+        for key in keys:
+            yield get_client().get(key)
+        return
+    client = get_client()
+    executor = get_executor()
+    pending = deque()
+    keys = iter(keys)
+    try:
+        for key in keys:
+            pending.append(executor.submit(client.get, key))
+            if len(pending) >= read_ahead:
+                break
+        while pending:
+            future = pending.popleft()
+            key = next(keys, None)
+            if key is not None:
+                pending.append(executor.submit(client.get, key))
+            yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def commit_multi(entities=None, keys=None, transaction=False):
+    """Put entities and delete keys in a single commit - a non-transactional commit
+    may apply only some of the mutations, so use a transaction if they must go together.
+    """
+    client = get_client()
+    with client.transaction() if transaction else client.batch() as batch:
+        for entity in entities or []:
+            batch.put(entity)
+        for key in keys or []:
+            batch.delete(key)
+
+
+def run_parallel(func, iterable, max_pending=4):
+    """Call func for each item on the thread pool, with up to max_pending calls
+    in flight, and return the results in order."""
+    executor = get_executor()
+    pending = deque()
+    result = []
+    for item in iterable:
+        if len(pending) >= max_pending:
+            result.append(pending.popleft().result())
+        pending.append(executor.submit(func, item))
+    while pending:
+        result.append(pending.popleft().result())
+    return result
+
+
+def delete_multi(keys, max_pending=4):
+    """Delete keys in batches of MAX_BATCH_ENTITIES, running the batches in parallel."""
+    batches = [
+        keys[i : i + MAX_BATCH_ENTITIES]
+        for i in range(0, len(keys), MAX_BATCH_ENTITIES)
+    ]
+    return run_parallel(get_client().delete_multi, batches, max_pending=max_pending)
+
+
 def put_entity(entity):
     return get_client().put(entity)
 
 
+def put_multi(entities):
+    return get_client().put_multi(entities)
+
+
 def get_query(kind, **kwargs):
     # namespace = kwargs.pop("namespace", None)
     # project = kwargs.pop("project", None)
@@ -94,48 +327,83 @@ def get_query(kind, **kwargs):
     return query
 
 
+def fetch_page(query, limit=1000, cursor=None, offset=0):
+    """Fetch one page of query results starting at cursor - returns (results, next_cursor)
+
+    The next_cursor is an opaque string to pass back for the next page, or None
+    after the last page. Unlike an offset, the datastore doesn't need to skip over
+    the previous results here, so deep pages cost the same as the first one.
+    """
+    iterator = query.fetch(limit, offset, start_cursor=cursor or None)
+    page = next(iterator.pages, None)
+    result = list(page) if page is not None else []
+    next_cursor = iterator.next_page_token
+    if isinstance(next_cursor, bytes):
+        next_cursor = next_cursor.decode("ascii")
+    return result, next_cursor
+
+
 def list_entities(kind, limit=1000, offset=0, **kwargs):
-    # TODO: use cursors in fetch() below if needed
-    kwargs.pop("start_cursor", None)
-    kwargs.pop("end_cursor", None)
+    start_cursor = kwargs.pop("start_cursor", None)
+    end_cursor = kwargs.pop("end_cursor", None)
     query = get_query(kind=kind, **kwargs)
     # result = {}
     # for entity in query.fetch(limit, offset):
     #     result[entity.key.id_or_name] = entity
-    result = list(query.fetch(limit, offset))
+    result = list(
+        query.fetch(limit, offset, start_cursor=start_cursor, end_cursor=end_cursor)
+    )
     return result
 
 
 def ilist_entities(kind, limit=1000, offset=0, **kwargs):
-    # TODO: use cursors in fetch() below if needed
-    kwargs.pop("start_cursor", None)
-    kwargs.pop("end_cursor", None)
+    start_cursor = kwargs.pop("start_cursor", None)
+    end_cursor = kwargs.pop("end_cursor", None)
     query = get_query(kind=kind, **kwargs)
-    yield from query.fetch(limit, offset)
+    yield from query.fetch(
+        limit, offset, start_cursor=start_cursor, end_cursor=end_cursor
+    )
+
+
+def list_entities_page(kind, limit=1000, cursor=None, offset=0, **kwargs):
+    query = get_query(kind=kind, **kwargs)
+    return fetch_page(query, limit, cursor, offset)
 
 
 def list_entity_keys(kind, limit=1000, offset=0, **kwargs):
-    # TODO: use cursors in fetch() below if needed
-    kwargs.pop("start_cursor", None)
-    kwargs.pop("end_cursor", None)
+    start_cursor = kwargs.pop("start_cursor", None)
+    end_cursor = kwargs.pop("end_cursor", None)
     query = get_query(kind=kind, **kwargs)
     query.keys_only()
     # result = [entity.key.id_or_name for entity in query.fetch(limit, offset)]
-    result = [entity.key for entity in query.fetch(limit, offset)]
+    result = [
+        entity.key
+        for entity in query.fetch(
+            limit, offset, start_cursor=start_cursor, end_cursor=end_cursor
+        )
+    ]
     return result
 
 
 def ilist_entity_keys(kind, limit=1000, offset=0, **kwargs):
-    # TODO: use cursors in fetch() below if needed
-    kwargs.pop("start_cursor", None)
-    kwargs.pop("end_cursor", None)
+    start_cursor = kwargs.pop("start_cursor", None)
+    end_cursor = kwargs.pop("end_cursor", None)
     query = get_query(kind=kind, **kwargs)
     query.keys_only()
-    for entity in query.fetch(limit, offset):
+    for entity in query.fetch(
+        limit, offset, start_cursor=start_cursor, end_cursor=end_cursor
+    ):
         # yield entity.key.id_or_name
         yield entity.key
 
 
+def list_entity_keys_page(kind, limit=1000, cursor=None, offset=0, **kwargs):
+    query = get_query(kind=kind, **kwargs)
+    query.keys_only()
+    result, next_cursor = fetch_page(query, limit, cursor, offset)
+    return [entity.key for entity in result], next_cursor
+
+
 # https://cloud.google.com/datastore/docs/concepts/metadataqueries#namespace_queries
 def list_namespaces():
     query = get_query(kind="__namespace__")
@@ -198,6 +466,27 @@ def get_properties_for_kind(kind):
 _class_map = {}
 
 
+class EntityProperty:
+    """Data descriptor for an entity property, added by ModelType for each _template key"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return instance._entity[self.name]
+        except (KeyError, TypeError):
+            # fall back to Model.__getattr__()
+            raise AttributeError(self.name)
+
+    def __set__(self, instance, value):
+        instance._entity[self.name] = value
+
+
 # Register Model classes so we can convert an entity to the right class again
 class ModelType(type):
     def __init__(cls, name, bases, dct):
@@ -205,6 +494,11 @@ class ModelType(type):
         # print("Getting properties for %s" % cls._kind)
         # cls._properties = get_properties_for_kind(cls._kind)
         _class_map[cls.__name__] = cls
+        # add descriptors for the known properties, so we don't need to go through
+        # __getattr__() for them - but don't hide methods or attributes of the class
+        for key in dct.get("_template", {}):
+            if not key.startswith("_") and key not in dct:
+                setattr(cls, key, EntityProperty(key))
 
 
 # https://python-future.org/compatible_idioms.html#metaclasses
@@ -218,6 +512,8 @@ class Model(metaclass=ModelType):
     _auto_now = None
     _entity = None
     _properties = {}
+    # default values for new entities - see ModelType for the property descriptors
+    _template = {}
 
     # def __init__(self, parent=None, key_name=None, _app=None, _from_entity=False, **kwargs):
     def __init__(self, _from_entity=False, **kwargs):
@@ -247,16 +543,17 @@ class Model(metaclass=ModelType):
 
     def __setattr__(self, key, value):
         # if key != "_entity" and self._entity:
-        if not key.startswith("_") and self._entity:
+        if key[0] != "_" and self._entity is not None:
             self._entity[key] = value
             return
         super().__setattr__(key, value)
 
-    def __getattribute__(self, key):
+    def __getattr__(self, key):
+        # only called when the normal lookup fails, e.g. for properties without descriptor
         # if key != "_entity" and self._entity and key in self._entity:
-        if not key.startswith("_") and self._entity and key in self._entity:
+        if key[0] != "_" and self._entity is not None and key in self._entity:
             return self._entity[key]
-        return super().__getattribute__(key)
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {key!r}")
 
     def key(self):
         # if self._entity and hasattr(self._entity, "key"):
@@ -273,10 +570,13 @@ class Model(metaclass=ModelType):
             return False
         return True
 
-    def put(self, *args, **kwargs):
+    def set_auto_now(self):
         if self._auto_now:
             for attr in self._auto_now:
                 self._entity[attr] = datetime.datetime.now(datetime.UTC)
+
+    def put(self, *args, **kwargs):
+        self.set_auto_now()
         return get_client().put(self._entity)
 
     def delete(self):
@@ -340,6 +640,12 @@ class Model(metaclass=ModelType):
             instance = cls.from_entity(entity)
             yield instance
 
+    @classmethod
+    def list_page(cls, limit=1000, cursor=None, **kwargs):
+        query = cls.query(**kwargs)
+        result, next_cursor = fetch_page(query, limit, cursor)
+        return [cls.from_entity(entity) for entity in result], next_cursor
+
     @classmethod
     def get_count(cls, limit=1000, offset=0, **kwargs):
         query = cls.query(**kwargs)
@@ -400,7 +706,8 @@ class CachedModel(Model):
     # https://stackoverflow.com/questions/4566769/can-i-memoize-a-python-generator/10726355
     def iget_content(self):
         cache_key = self._kind + "." + str(self.get_key_name())
-        result = self.cache.get_list(cache_key)
+        version = self.cache.get_list_version(cache_key)
+        result = self.cache.get_list(cache_key, version)
         if result:
             logging.debug("CachedModel.iget_content: HIT %r" % result)
             yield from result
@@ -411,7 +718,7 @@ class CachedModel(Model):
             result.append(instance)
             yield instance
         logging.debug("CachedModel.iget_content: MISS %r" % result)
-        self.cache.set_list(cache_key, result)
+        self.cache.set_list(cache_key, result, version=version)
         # preset items in cache since we will probably need them right after this
         # if isinstance(result, list) and len(result) > 0 and isinstance(result[0], CachedModel):
         #     for item in result:
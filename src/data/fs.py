@@ -11,7 +11,9 @@ File system operations.
 import io
 import logging
 import time
+from collections import deque
 
+from . import db
 from .model import Dir, File, Path
 
 # from btfs import memcash
@@ -35,7 +37,7 @@ def initfs(backend="datastore", readonly=False):
 
 
 # @memcash.cache(ttl=10)  # cache function result for 10 seconds
-def _getresource(path):
+def _getresource(path, environ=None):
     """Return a model.Dir or model.File object for `path`.
 
     `path` may be an existing Dir/File entity.
@@ -45,43 +47,45 @@ def _getresource(path):
 
         statresults = data.fs.stat(self.pathEntity)
 
+    or to pass the WSGI environ, so lookups are cached for the rest of the request.
+
     Return None, if path does not exist.
     """
     if type(path) in (Dir, File):
         logging.debug("_getresource(%r): request cache HIT" % path.path)
         return path
     # logging.info("_getresource(%r)" % path)
-    p = Path.retrieve(path)
+    p = Path.retrieve(path, environ)
     assert p is None or type(p) in (Dir, File)
     return p
 
 
-def getdir(s):
-    p = _getresource(s)
+def getdir(s, environ=None):
+    p = _getresource(s, environ)
     if type(p) is Dir:
         return p
     return None
 
 
-def getfile(s):
-    p = _getresource(s)
+def getfile(s, environ=None):
+    p = _getresource(s, environ)
     if type(p) is File:
         return p
     return None
 
 
-def isdir(s):
-    p = getdir(s)
+def isdir(s, environ=None):
+    p = getdir(s, environ)
     return p is not None
 
 
-def isfile(s):
-    p = getfile(s)
+def isfile(s, environ=None):
+    p = getfile(s, environ)
     return p is not None
 
 
-def exists(s):
-    return _getresource(s) is not None
+def exists(s, environ=None):
+    return _getresource(s, environ) is not None
 
 
 def stat(s):
@@ -183,8 +187,8 @@ def copyfile(s, d):
         dst = File.new(path=d)
     if not dst.isfile():
         raise ValueError("destination not a File %r" % d)
-    # TODO: copyfile2 without downloading/uploading chunk data at all?
-    dst.iput_content(src.iget_content())
+    # clone the chunk entities instead of joining and splitting the data again
+    dst.copy_content(src)
     # raise, if not exists:
     # sio = btopen(s, "rb")
     # overwrite destination, if exists:
@@ -199,6 +203,14 @@ def copyfile(s, d):
     return
 
 
+def rename(s, d):
+    """Rename a file or directory (with its whole subtree) without moving any chunks"""
+    src = _getresource(s)
+    if src is None:
+        raise ValueError("source not found %r" % s)
+    return src.rename(d)
+
+
 def unlink(s):
     f = getfile(s)
     f.delete()
@@ -206,27 +218,37 @@ def unlink(s):
 
 
 def btopen(s, mode="r"):
-    """Open the file (eg. return a BtIO object)"""
+    """Open the file (eg. return a BtReader in read mode, a BtWriter in write mode,
+    or a BtIO object otherwise)"""
     f = getfile(s)
     if f is None:
         # Create targtet file, but only in write mode
         if "w" not in mode and "a" not in mode and "x" not in mode:
             raise ValueError("source not found %r" % s)
         f = File.new(path=s)
+    if is_readonly(mode):
+        return BtReader(f)
+    if ("w" in mode or "x" in mode) and "+" not in mode:
+        return BtWriter(f, mode)
     io = BtIO(f, mode)
     return io
 
 
-def listdir(s):
-    p = getdir(s)
+def is_readonly(mode):
+    return "w" not in mode and "a" not in mode and "x" not in mode and "+" not in mode
+
+
+def listdir(s, environ=None):
+    p = getdir(s, environ)
     # path_str = [c.basename(c.path).encode('utf-8') for c in p.get_content()]
-    path_str = [c.basename(c.path) for c in p.get_content()]
+    # path_str = [c.basename(c.path) for c in p.get_content(environ)]
+    path_str = p.listdir(environ)
     return path_str
 
 
-def scandir(s):
-    p = getdir(s)
-    return p.get_content()
+def scandir(s, environ=None):
+    p = getdir(s, environ)
+    return p.get_content(environ)
 
 
 def stop_cache(stop=False):
@@ -244,16 +266,15 @@ class BtIO(io.BytesIO):
     def __init__(self, btfile, mode):
         self.btfile = btfile
         self.mode = mode
-        io.BytesIO.__init__(self, btfile.get_content())
+        if "w" in mode or "x" in mode:
+            # no need to load the existing content if we overwrite it anyway
+            io.BytesIO.__init__(self)
+        else:
+            io.BytesIO.__init__(self, btfile.get_content())
         return
 
     def is_readonly(self):
-        return (
-            "w" not in self.mode
-            and "a" not in self.mode
-            and "x" not in self.mode
-            and "+" not in self.mode
-        )
+        return is_readonly(self.mode)
 
     def flush(self):
         io.BytesIO.flush(self)
@@ -272,3 +293,219 @@ class BtIO(io.BytesIO):
                 self.close()
         except AttributeError:
             pass
+
+
+# ===============================================================================
+# BtReader
+# ===============================================================================
+class BtReader(io.RawIOBase):
+    """
+    Bigtable file reader - seekable, and only fetching the chunks we read from.
+    Once we read on past the end of a chunk, the next chunks are fetched ahead
+    like in File.iget_content(), until we seek somewhere else.
+    """
+
+    def __init__(self, btfile):
+        self.btfile = btfile
+        self.mode = "rb"
+        self.name = btfile.path
+        self._size = btfile.size
+        self._pos = 0
+        self._chunk_offset = 0
+        self._chunk_data = b""
+        # iterator over the next chunks for sequential reads, see _next_chunk()
+        self._chunks = None
+        # limit the number of chunks in memory (fetched but not consumed yet)
+        self._read_ahead = min(
+            btfile.ReadAhead, btfile.ReadAheadBytes // btfile.ChunkSize
+        )
+        return
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %r" % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self._pos >= self._size:
+            return 0
+        start = self._pos - self._chunk_offset
+        if start < 0 or start >= len(self._chunk_data):
+            self._chunk_offset, self._chunk_data = self._next_chunk()
+            start = self._pos - self._chunk_offset
+        # return what is left in this chunk - the caller will ask for more if needed
+        view = memoryview(self._chunk_data)[start : start + len(b)]
+        length = len(view)
+        b[:length] = view
+        self._pos += length
+        return length
+
+    def _next_chunk(self):
+        """
+        Return (offset, data) for the chunk containing the current position.
+        """
+        if self._chunk_data and self._pos == self._chunk_offset + len(self._chunk_data):
+            # sequential read - continue with the chunks fetched ahead
+            if self._chunks is None:
+                self._chunks = self.btfile.iget_range_chunks(
+                    self._pos, self._size, self._read_ahead
+                )
+            offset, data = next(self._chunks, (self._pos, b""))
+            if offset <= self._pos < offset + len(data):
+                return offset, data
+        # random access - only fetch the chunk we need
+        self._close_chunks()
+        return self.btfile.get_chunk_at(self._pos)
+
+    def _close_chunks(self):
+        if self._chunks is not None:
+            # cancel the pending requests for the chunks we won't read
+            self._chunks.close()
+            self._chunks = None
+
+    def readall(self):
+        result = self.btfile.read_range(self._pos)
+        self._pos += len(result)
+        return result
+
+    def close(self):
+        self._close_chunks()
+        self._chunk_data = b""
+        io.RawIOBase.close(self)
+        return
+
+
+# ===============================================================================
+# BtWriter
+# ===============================================================================
+class BtWriter(io.RawIOBase):
+    """
+    Bigtable file writer - puts each chunk as soon as it is complete,
+    so we never hold more than a few chunks in memory.
+
+    The new content only replaces the old one when close() is called explicitly
+    - a writer that is aborted, garbage-collected or left by an exception in a
+    with block discards what was written so far.
+    """
+
+    background = True  # put the chunks in the background while receiving more data
+    max_pending = 2  # with at most 2 chunks waiting to be saved
+
+    def __init__(self, btfile, mode):
+        self.btfile = btfile
+        self.mode = mode
+        self.name = btfile.path
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pending = deque()
+        btfile.begin_write()
+        return
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._offset + len(self._buffer)
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("write to closed file")
+        length = len(b)
+        self._buffer.extend(b)
+        chunk_size = self.btfile.ChunkSize
+        while len(self._buffer) >= chunk_size:
+            data = bytes(self._buffer[:chunk_size])
+            del self._buffer[:chunk_size]
+            self._put_chunk(data)
+        return length
+
+    def _put_chunk(self, data):
+        offset = self._offset
+        self._offset += len(data)
+        if not self.background:
+            self.btfile.put_chunk(offset, data)
+            return
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        future = db.get_executor().submit(self.btfile.put_chunk, offset, data)
+        self._pending.append(future)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._commit()
+        except BaseException:
+            # discard the chunks put so far - the file keeps its old content
+            self.abort()
+            raise
+        io.RawIOBase.close(self)
+        return
+
+    def _commit(self):
+        while self._pending:
+            self._pending.popleft().result()
+        if self._offset == 0 and len(self._buffer) <= self.btfile.InlineSize:
+            # small enough to keep inline in the file entity, without chunks
+            data = bytes(self._buffer)
+            self._buffer = bytearray()
+            self.btfile.commit_write(len(data), inline_data=data)
+            return
+        # save the last chunk together with the file size and modify_time
+        batch = []
+        if len(self._buffer) > 0:
+            data = bytes(self._buffer)
+            ck = self.btfile.new_chunk(self._offset, data)
+            batch.append(ck._entity)
+            self._offset += len(data)
+            self._buffer = bytearray()
+        self.btfile.commit_write(self._offset, batch)
+
+    def abort(self):
+        """Close without saving - the file keeps its old content"""
+        if self.closed:
+            return
+        try:
+            while self._pending:
+                future = self._pending.popleft()
+                future.cancel()
+                try:
+                    future.result()
+                except Exception:
+                    pass
+            self._buffer = bytearray()
+            self.btfile.abort_write()
+        finally:
+            io.RawIOBase.close(self)
+        return
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # io.IOBase.__del__ would close() and save a partial upload here
+        try:
+            self.abort()
+        except Exception:
+            pass
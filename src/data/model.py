@@ -7,24 +7,157 @@
 # (c) 2009 Haoyu Bai (http://gaedav.google.com/).
 
 
+import atexit
 import datetime
 import hashlib
 import logging
 import os.path
+import threading
+import uuid
+import zlib
+from collections import namedtuple
+
+from google.cloud import datastore
 
 from . import db
-from .cache import NamespacedCache
+from .cache import NamespacedCache, RequestCache
 
-cached_resource = NamespacedCache("resource")
+cached_resource = NamespacedCache("resource", use_local=True)
 
 DO_EXPENSIVE_CHECKS = False
 # DO_EXPENSIVE_CHECKS = True
 
+# look up paths by key name first (see Path.set_key), instead of querying on path
+LOOKUP_BY_KEY = True
+# fall back to a query on path for legacy entities that were saved with another key
+LOOKUP_FALLBACK_QUERY = True
+
+# compress chunk data with this codec (see Chunk.register_codec) - or None to disable
+CHUNK_CODEC = "zlib"
+
+# roll up the changes in count and total_size of the directories every few seconds,
+# instead of updating all the parent directories for every write (see Dir.add_aggregates)
+AGGREGATE_FLUSH_INTERVAL = 5.0
+
+# delete the chunks of replaced or deleted content after this delay, so readers that
+# still have the old file entity can finish streaming it (see File.begin_write) - the
+# pending deletes are saved as DeletedContent entities, so any process can collect them
+CONTENT_GC_DELAY = 600.0
+
+# check for DeletedContent that is due this often, once a process wrote or deleted content
+CONTENT_GC_INTERVAL = 60.0
+
 
 class UnmappedPath:
     """Dummy object to cache lookups for non-existent URLs."""
 
 
+# cache lookups for non-existent paths for 10 seconds (see Path.retrieve) - or 0 to disable
+NOT_FOUND_TIMEOUT = 10
+
+
+# ===============================================================================
+# PathRecord
+# ===============================================================================
+class RecordEntity(datastore.Entity):
+    """
+    Entity of a Dir or File made from a PathRecord - this keeps track of the properties
+    that are set or removed afterwards, so Path.load_entity() only changes those in the
+    full entity (and not e.g. the parent_path or size we derived from the record).
+    """
+
+    def __init__(self, key=None, exclude_from_indexes=()):
+        super().__init__(key=key, exclude_from_indexes=exclude_from_indexes)
+        self.changed = set()
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self.changed.add(name)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.changed.add(name)
+
+    def pop(self, name, *args):
+        self.changed.add(name)
+        return super().pop(name, *args)
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+
+class PathRecord(
+    namedtuple(
+        "PathRecord",
+        "path kind size create_time modify_time key_name content",
+    )
+):
+    """
+    Compact record of a Dir or File, used to store them in the cache and in the cached
+    directory listings instead of the whole model with its entity.
+
+    For files, content is a tuple (content_key_path, chunk_size, inline_data) with what
+    we need to read the content, and for directories a tuple (count, total_size).
+    The content_key_path is the flat_path of the content key, which is the Path key of
+    the file for older files, or the path they had before they were renamed.
+    In directory listings inline_data is True instead of the data, to keep them small.
+    See Path.to_record() and PathRecord.to_model().
+    """
+
+    __slots__ = ()
+
+    def to_model(self):
+        """
+        Return a Dir or File instance for reading - the full entity will be loaded
+        from the datastore if we write to it later (see Path.load_entity).
+        """
+        if self.kind == "Dir":
+            cls = Dir
+        else:
+            cls = File
+        values = {
+            "path": self.path,
+            "parent_path": None,
+            "class": ["Path", self.kind],
+            "size": self.size,
+            "create_time": self.create_time,
+            "modify_time": self.modify_time,
+        }
+        if self.path != "/":
+            # this may differ from the parent_path of older entities - see load_entity
+            values["parent_path"] = Path.get_key_for(os.path.dirname(self.path))
+        inline_omitted = False
+        if self.content and self.kind == "Dir":
+            values["count"], values["total_size"] = self.content
+        elif self.content:
+            content_key_path, chunk_size, inline_data = self.content
+            if isinstance(content_key_path, str):
+                # older records only had the name of a Content key
+                content_key_path = ("Content", content_key_path)
+            if content_key_path:
+                values["content_key"] = db.get_client().key(*content_key_path)
+            if chunk_size:
+                values["chunk_size"] = chunk_size
+            if inline_data is True:
+                inline_omitted = True
+            elif inline_data is not None:
+                values["inline_data"] = inline_data
+        entity = RecordEntity(db.get_client().key(Path._kind, self.key_name))
+        # without tracking these as changes
+        dict.update(entity, values)
+        instance = cls.from_entity(entity)
+        instance._partial = True
+        if inline_omitted:
+            instance._inline_omitted = True
+        return instance
+
+
 # TODO: may apply the technique described here:
 # http://code.google.com/appengine/docs/python/datastore/keysandentitygroups.html
 
@@ -45,53 +178,240 @@ class Path(db.PolyModel):
     _auto_now = ["modify_time"]
 
     cache = cached_resource
+    # set for instances made from a PathRecord, until the full entity is loaded
+    _partial = False
+
+    _template = {
+        "path": "",
+        "size": 0,
+        "create_time": None,
+        "modify_time": None,
+    }
 
     def _init_entity(self, **kwargs):
         super()._init_entity(**kwargs)
         now = datetime.datetime.now(datetime.UTC)
-        template = {
-            "path": "",
-            "size": 0,
-            "create_time": now,
-            "modify_time": now,
-        }
+        template = dict(Path._template, create_time=now, modify_time=now)
         for key in template:
             self._entity.setdefault(key, template[key])
 
     def set_key(self):
-        if len(self.path) > 128:
-            self._entity.key = self._entity.key.completed_key(
-                hashlib.md5(self.path.encode("utf-8")).hexdigest()
-            )
-        else:
-            self._entity.key = self._entity.key.completed_key(self.path)
+        key_name = self.get_key_name_for(self.path)
+        self._entity.key = self._entity.key.completed_key(key_name)
 
     def put(self):
         logging.debug("Path.put(%r)" % (self.path))
         if not self.is_saved():
             self.set_key()
+        self.load_entity()
         db.Model.put(self)
-        self.cache.set(self.path, self)
-        self.cache.del_list(os.path.dirname(self.path))
+        self.update_cache()
         return
 
+    def update_cache(self):
+        self.cache.set(self.path, self.to_record())
+        self.cache.del_list(os.path.dirname(self.path))
+
+    def load_entity(self):
+        """
+        Load the full entity before we write it, if this instance was made from a
+        PathRecord - keeping the properties that were changed since then.
+        """
+        if not self._partial:
+            return
+        self._partial = False
+        entity = db.get_entity(self.key())
+        if entity is None:
+            return
+        for name in getattr(self._entity, "changed", ()):
+            # these are only updated by Dir.flush_aggregates()
+            if name in ("count", "total_size"):
+                continue
+            if name in self._entity:
+                entity[name] = self._entity[name]
+            else:
+                entity.pop(name, None)
+        self._entity = entity
+
+    def to_record(self, inline=True):
+        """
+        Return the PathRecord for the cache - with inline=False for directory listings.
+        """
+        return PathRecord(
+            self.path,
+            type(self).__name__,
+            self.size,
+            self.create_time,
+            self.modify_time,
+            self.key().id_or_name,
+            self._get_record_content(inline),
+        )
+
+    def _get_record_content(self, inline=True):
+        return None
+
+    @staticmethod
+    def _from_cache(result):
+        # older cache entries may still contain the whole model
+        if isinstance(result, PathRecord):
+            return result.to_model()
+        return result
+
     def delete(self):
         logging.debug("Path.delete(%r)" % (self.path))
         if self.path == "/":
             raise RuntimeError("Though shalt not delete root")
         self.cache.delete(self.path)
-        self.cache.del_list(os.path.dirname(self.path))
-        return db.Model.delete(self)
+        if self.isdir():
+            # a new directory at this path starts with an empty listing
+            self.cache.del_list_multi([os.path.dirname(self.path), self.path])
+        else:
+            self.cache.del_list(os.path.dirname(self.path))
+        size = self.size if self.isfile() else 0
+        # with the entities that go together with the delete, if any
+        entities = self._deleted_entities()
+        result = db.commit_multi(entities, [self.key()], transaction=len(entities) > 0)
+        # only once it's gone
+        Dir.add_aggregates(self.path, count=-1, size=-size)
+        return result
+
+    def _deleted_entities(self):
+        return []
 
     def __repr__(self):
         return f"{type(self).class_name()}('{self.path}')"
 
+    def rename(self, dst):
+        """
+        Rename this file or directory (with its whole subtree) to dst, by rewriting
+        only the Path entities - the chunks of the files stay where they are.
+        """
+        logging.debug(f"Path.rename({self.path!r}, {dst!r})")
+        dst = self.normalize(dst)
+        if dst == self.path:
+            return self
+        if self.path == "/":
+            raise RuntimeError("Though shalt not rename root")
+        if dst.startswith(self.path + "/"):
+            raise RuntimeError(f"Cannot rename {self.path!r} into itself: {dst!r}")
+        parent_path = Path.retrieve(self.get_parent_path(dst))
+        if type(parent_path) is not Dir:
+            raise RuntimeError("Parent must be a Dir for: %r" % dst)
+        if Path.retrieve(dst):
+            raise RuntimeError("Path exists: %r" % dst)
+        # the current aggregates of the directories are copied in _commit_renamed()
+        Dir.flush_aggregates()
+        items = [self]
+        if self.isdir():
+            items.extend(Path.ilist_by_prefix(self.path))
+        renamed = []
+        for item in items:
+            path = dst + item.path[len(self.path) :]
+            if item is self:
+                parent_key = parent_path.key()
+            else:
+                parent_key = Path.get_key_for(os.path.dirname(path))
+            renamed.append(item._renamed(path, parent_key))
+        # put the new entities and delete the old ones in the same transactions, so
+        # an entity is never deleted without its renamed copy
+        count = db.MAX_BATCH_ENTITIES // 2
+        batches = [
+            (
+                [item._entity for item in renamed[i : i + count]],
+                [item.key() for item in items[i : i + count]],
+            )
+            for i in range(0, len(items), count)
+        ]
+        db.run_parallel(self._commit_renamed, batches)
+        old_paths = [item.path for item in items]
+        new_paths = [item.path for item in renamed]
+        self.cache.delete_multi(old_paths + new_paths)
+        # with the listings of the new directory paths, which may be cached from
+        # directories that were there before
+        self.cache.del_list_multi(
+            [os.path.dirname(self.path), os.path.dirname(dst)]
+            + [item.path for item in items if item.isdir()]
+            + [item.path for item in renamed if item.isdir()]
+        )
+        size = sum(item.size for item in items if item.isfile())
+        Dir.add_aggregates(self.path, count=-1, size=-size)
+        Dir.add_aggregates(dst, count=1, size=size)
+        return renamed[0]
+
+    @staticmethod
+    def _commit_renamed(batch):
+        """
+        Put the renamed entities and delete the old keys in one transaction - with the
+        aggregates of the directories as they are now, not as we read them before.
+        """
+        entities, keys = batch
+        client = db.get_client()
+        with client.transaction():
+            dir_keys = [
+                key for entity, key in zip(entities, keys) if "total_size" in entity
+            ]
+            current = {}
+            if len(dir_keys) > 0:
+                current = {entity.key: entity for entity in client.get_multi(dir_keys)}
+            for entity, key in zip(entities, keys):
+                if key not in current:
+                    continue
+                for name in ("count", "total_size"):
+                    if name in current[key]:
+                        entity[name] = current[key][name]
+                    else:
+                        entity.pop(name, None)
+            client.put_multi(entities)
+            client.delete_multi(keys)
+
+    def _renamed(self, path, parent_key):
+        self.load_entity()
+        entity = db.make_entity(
+            self.get_key_for(path),
+            list(self._entity.exclude_from_indexes),
+            **self._entity,
+        )
+        entity["path"] = path
+        entity["parent_path"] = parent_key
+        return type(self).from_entity(entity)
+
     def isdir(self):
         return type(self) is Dir
 
     def isfile(self):
         return type(self) is File
 
+    @classmethod
+    def get_key_name_for(cls, path):
+        """Return the key name used by set_key() for this path."""
+        if len(path) > 128:
+            return hashlib.md5(path.encode("utf-8")).hexdigest()
+        return path
+
+    @classmethod
+    def get_key_for(cls, path):
+        return db.get_client().key(cls._kind, cls.get_key_name_for(path))
+
+    @classmethod
+    def get_by_path(cls, path):
+        """Get the path entity directly by key, without querying on path."""
+        entity = db.get_client().get(cls.get_key_for(path))
+        if entity is None or entity.get("path") != path:
+            return None
+        return cls.from_entity(entity)
+
+    @classmethod
+    def get_multi_by_path(cls, paths):
+        """Get the path entities directly by key - returns a dict of path: instance."""
+        paths = set(paths)
+        keys = [cls.get_key_for(path) for path in paths]
+        result = {}
+        for entity in db.get_client().get_multi(keys):
+            path = entity.get("path")
+            if path in paths:
+                result[path] = cls.from_entity(entity)
+        return result
+
     @classmethod
     def list_by_path(cls, path):
         # result = list(cls.gql("WHERE path = :1", path))
@@ -133,6 +453,29 @@ class Path(db.PolyModel):
         for entity in query.fetch():
             yield cls.from_entity(entity)
 
+    @classmethod
+    def ilist_paths_by_parent_path(cls, parent_path):
+        """Return only the paths of the children via a projection query on path"""
+        query = db.get_client().query(kind="Path")
+        query.projection = ["path"]
+        if isinstance(parent_path, db.Model):
+            query.add_filter("parent_path", "=", parent_path.key())
+        else:
+            query.add_filter("parent_path", "=", parent_path)
+        for entity in query.fetch():
+            yield entity["path"]
+
+    @classmethod
+    def ilist_by_prefix(cls, path):
+        """Return all descendants of path (at all levels) via a range query on path"""
+        prefix = path.rstrip("/") + "/"
+        query = db.get_client().query(kind="Path")
+        query.add_filter("path", ">", prefix)
+        # "0" is the next character after "/"
+        query.add_filter("path", "<", prefix[:-1] + "0")
+        for entity in query.fetch():
+            yield cls.from_entity(entity)
+
     @classmethod
     def normalize(cls, p):
         """
@@ -182,30 +525,100 @@ class Path(db.PolyModel):
     #     return result is not None
 
     @classmethod
-    def retrieve(cls, path):
+    def get_cache(cls, environ=None):
+        """
+        Return the cache to use - with a request cache in front if we have an environ.
+        """
+        if environ is None:
+            return cls.cache
+        return RequestCache(cls.cache, environ)
+
+    @classmethod
+    def retrieve(cls, path, environ=None):
         logging.debug(f"Path.retrieve({cls.__name__}, {path!r})")
         assert cls is Path
         path = cls.normalize(path)
         assert path.startswith("/")
-        result = cls.cache.get(path)
+        cache = cls.get_cache(environ)
+        result = cache.get(path)
+        if isinstance(result, UnmappedPath):
+            return None
         if result:
             # logging.debug('Cached result: %s' % result)
-            return result
+            return cls._from_cache(result)
+        if LOOKUP_BY_KEY:
+            result = cls.get_by_path(path)
+            if result:
+                cache.set(path, result.to_record())
+                return result
+            if not LOOKUP_FALLBACK_QUERY:
+                cls.cache_not_found([path], cache)
+                return None
+        return cls._retrieve_by_query(path, cache)
+
+    @classmethod
+    def _retrieve_by_query(cls, path, cache=None):
+        cache = cache or cls.cache
         # result = list(cls.gql("WHERE path = :1", path))
         result = cls.list_by_path(path)
         if len(result) == 1:
             result = result[0]
             # assert type(result) in (Path, cls)
-            cls.cache.set(path, result)
+            cache.set(path, result.to_record())
             # logging.debug('New result: %s' % result)
             return result
         elif len(result) == 0:
-            # TODO: cache 'Not found' also
             # logging.debug('No result')
+            cls.cache_not_found([path], cache)
             return None
         else:
             raise ValueError("The given path has more than one entities", path)
 
+    @classmethod
+    def retrieve_multi(cls, paths, environ=None):
+        """Retrieve several paths at once - returns a dict of path: instance or None."""
+        assert cls is Path
+        paths = [cls.normalize(path) for path in paths]
+        result = {}
+        missing = []
+        cache = cls.get_cache(environ)
+        for path in paths:
+            result[path] = cls._from_cache(cache.get(path))
+            if isinstance(result[path], UnmappedPath):
+                result[path] = None
+            elif not result[path]:
+                missing.append(path)
+        if len(missing) < 1:
+            return result
+        if LOOKUP_BY_KEY:
+            found = cls.get_multi_by_path(missing)
+            for path, instance in found.items():
+                cache.set(path, instance.to_record())
+                result[path] = instance
+            missing = [path for path in missing if path not in found]
+            if not LOOKUP_FALLBACK_QUERY:
+                cls.cache_not_found(missing, cache)
+                return result
+        for path in missing:
+            result[path] = cls._retrieve_by_query(path, cache)
+        return result
+
+    @classmethod
+    def cache_not_found(cls, paths, cache=None):
+        """
+        Cache the paths as not found for a short time - Path.put() replaces the entry.
+        """
+        cache = cache or cls.cache
+        if len(paths) < 1:
+            return
+        mapping = {path: UnmappedPath() for path in paths}
+        if isinstance(cache, RequestCache):
+            # remember them for the rest of the request in any case
+            cache.set_local_multi(mapping)
+        if not NOT_FOUND_TIMEOUT:
+            return
+        cache.set_multi(mapping, time=NOT_FOUND_TIMEOUT)
+
     @classmethod
     def new(cls, path):
         # Make sure, we don't instantiate <Path> objects
@@ -232,6 +645,8 @@ class Path(db.PolyModel):
             logging.debug("No complete key available yet")
             result.set_key()
         result.put()
+        if path != "/":
+            Dir.add_aggregates(path, count=1)
         return result
 
     @staticmethod
@@ -293,8 +708,7 @@ class Path(db.PolyModel):
             dst = File.new(path=d)
         if not dst.isfile():
             raise ValueError("Destination not a File %r" % d)
-        # TODO: copyfile2 without downloading/uploading chunk data at all?
-        dst.iput_content(src.iget_content())
+        dst.copy_content(src)
         return
 
     @staticmethod
@@ -313,26 +727,192 @@ class Dir(Path):
     # _auto_now = ['modify_time']
     # cache = cached_dir
 
+    _template = {
+        "parent_path": None,
+        # number of entries in this directory, and total size of the files in its subtree
+        "count": 0,
+        "total_size": 0,
+    }
+    # pending changes in (count, total_size) by path - see add_aggregates()
+    _pending_aggregates = {}
+    _aggregates_lock = threading.Lock()
+    _aggregates_timer = None
+
     def _init_entity(self, **kwargs):
         super()._init_entity(**kwargs)
-        self._entity.setdefault("parent_path", None)
+        for key in self._template:
+            self._entity.setdefault(key, self._template[key])
 
-    def get_content(self):
+    def _get_record_content(self, inline=True):
+        if "total_size" not in self._entity:
+            return None
+        return (self._entity.get("count", 0), self._entity["total_size"])
+
+    def put(self):
+        if not self.is_saved():
+            self.set_key()
+        self.load_entity()
+        # keep the aggregates that flush_aggregates() updated since we read them
+        client = db.get_client()
+        with client.transaction():
+            entity = client.get(self.key())
+            if entity is not None:
+                for name in ("count", "total_size"):
+                    if name in entity:
+                        self._entity[name] = entity[name]
+                    else:
+                        self._entity.pop(name, None)
+            db.Model.put(self)
+        self.update_cache()
+        return
+
+    def get_aggregates(self):
+        """
+        Return (count, total_size) for this directory - without the changes that are
+        still pending, see add_aggregates() - or (None, None) for directories saved
+        before we kept aggregates, until rebuild_aggregates() is run for them.
+        """
+        if "total_size" not in self._entity:
+            return None, None
+        return self._entity.get("count", 0), self._entity["total_size"]
+
+    def rebuild_aggregates(self):
+        """
+        Count the entries and add up the file sizes in the whole subtree, for directories
+        saved before we kept aggregates - they are updated incrementally after that.
+        This scans the whole subtree, so run it offline (see admin_data.py).
+        """
+        logging.debug(f"Dir.rebuild_aggregates: {self.path!r}")
+        count = 0
+        total_size = 0
+        for item in Path.ilist_by_prefix(self.path):
+            if os.path.dirname(item.path) == self.path:
+                count += 1
+            if item.isfile():
+                total_size += item.size
+        with self._aggregates_lock:
+            self._pending_aggregates.pop(self.path, None)
+        client = db.get_client()
+        with client.transaction():
+            entity = client.get(self.key())
+            if entity is None:
+                return
+            entity["count"] = count
+            entity["total_size"] = total_size
+            client.put(entity)
+        self._entity["count"] = count
+        self._entity["total_size"] = total_size
+        self.cache.set(self.path, Path.from_entity(entity).to_record())
+
+    @classmethod
+    def add_aggregates(cls, path, count=0, size=0):
+        """
+        Add count to the parent directory of path, and size to all its ancestors - the
+        changes are rolled up in the background every AGGREGATE_FLUSH_INTERVAL seconds.
+        """
+        if not count and not size:
+            return
+        parent = os.path.dirname(path)
+        changes = {}
+        while path != "/":
+            path = os.path.dirname(path)
+            changes[path] = (count if path == parent else 0, size)
+        cls._add_pending(changes)
+
+    @classmethod
+    def _add_pending(cls, changes):
+        with cls._aggregates_lock:
+            for path, (count, size) in changes.items():
+                pending = cls._pending_aggregates.setdefault(path, [0, 0])
+                pending[0] += count
+                pending[1] += size
+            if cls._aggregates_timer is None:
+                timer = threading.Timer(AGGREGATE_FLUSH_INTERVAL, cls.flush_aggregates)
+                timer.daemon = True
+                timer.start()
+                cls._aggregates_timer = timer
+
+    @classmethod
+    def flush_aggregates(cls):
+        """
+        Roll up the pending changes into the Dir entities, with a transaction per batch.
+        """
+        with cls._aggregates_lock:
+            pending = cls._pending_aggregates
+            cls._pending_aggregates = {}
+            if cls._aggregates_timer is not None:
+                cls._aggregates_timer.cancel()
+                cls._aggregates_timer = None
+        paths = [path for path in pending if pending[path] != [0, 0]]
+        count = db.MAX_BATCH_ENTITIES
+        for i in range(0, len(paths), count):
+            batch = paths[i : i + count]
+            try:
+                cls._update_aggregates(batch, pending)
+            except Exception as e:
+                # try again with the next roll-up
+                logging.warning("Dir.flush_aggregates: %s" % e)
+                cls._add_pending({path: pending[path] for path in batch})
+
+    @classmethod
+    def _flush_at_exit(cls):
+        if not cls._pending_aggregates:
+            return
+        try:
+            cls.flush_aggregates()
+        except Exception as e:
+            logging.info("Dir.flush_aggregates: %s" % e)
+
+    @classmethod
+    def _after_fork(cls):
+        # the parent process flushes its own pending changes, and the timer is gone here
+        cls._aggregates_lock = threading.Lock()
+        cls._pending_aggregates = {}
+        cls._aggregates_timer = None
+
+    @classmethod
+    def _update_aggregates(cls, paths, pending):
+        client = db.get_client()
+        with client.transaction():
+            entities = client.get_multi([Path.get_key_for(path) for path in paths])
+            # leave directories without aggregates for rebuild_aggregates()
+            entities = [entity for entity in entities if "total_size" in entity]
+            for entity in entities:
+                count, size = pending[entity["path"]]
+                entity["count"] = entity.get("count", 0) + count
+                entity["total_size"] += size
+            if len(entities) > 0:
+                client.put_multi(entities)
+        if len(entities) > 0:
+            cls.cache.set_multi(
+                {
+                    entity["path"]: Path.from_entity(entity).to_record()
+                    for entity in entities
+                }
+            )
+            # the records in the listings of the parents have the aggregates too
+            cls.cache.del_list_multi(
+                list({os.path.dirname(entity["path"]) for entity in entities})
+            )
+
+    def get_content(self, environ=None):
         # result = list(self.dir_set) + list(self.file_set)
         # logging.debug("Dir.get_content: %r" % result)
         # TODO: ORDER BY
         # result = list(Path.gql("WHERE parent_path=:1", self))
-        result = self.cache.get_list(self.path)
+        cache = self.get_cache(environ)
+        version = cache.get_list_version(self.path)
+        result = cache.get_list(self.path, version)
         if result:
             logging.debug("Dir.get_content: HIT %r" % result)
-            return result
+            return [self._from_cache(item) for item in result]
         result = Path.list_by_parent_path(self)
         logging.debug("Dir.get_content: MISS %r" % result)
-        self.cache.set_list(self.path, result)
+        records = [item.to_record(inline=False) for item in result]
+        cache.set_list(self.path, records, version=version)
         # preset items in cache since we will probably need them right after this
-        if isinstance(result, list) and len(result) > 0 and isinstance(result[0], Path):
-            for item in result:
-                self.cache.set(item.path, item)
+        if len(records) > 0:
+            cache.set_multi({item.path: item.to_record() for item in result})
         return result
 
     # https://stackoverflow.com/questions/4566769/can-i-memoize-a-python-generator/10726355
@@ -341,26 +921,47 @@ class Dir(Path):
         # logging.debug("Dir.get_content: %r" % result)
         # TODO: ORDER BY
         # result = list(Path.gql("WHERE parent_path=:1", self))
-        result = self.cache.get_list(self.path)
+        version = self.cache.get_list_version(self.path)
+        result = self.cache.get_list(self.path, version)
         if result:
             logging.debug("Dir.iget_content: HIT %r" % result)
             for item in result:
-                yield item
+                yield self._from_cache(item)
             return
-        result = []
+        records = []
+        items = {}
         for item in Path.ilist_by_parent_path(self):
-            result.append(item)
+            records.append(item.to_record(inline=False))
+            items[item.path] = item.to_record()
             yield item
-        logging.debug("Dir.iget_content: MISS %r" % result)
-        self.cache.set_list(self.path, result)
+        logging.debug("Dir.iget_content: MISS %r" % records)
+        self.cache.set_list(self.path, records, version=version)
         # preset items in cache since we will probably need them right after this
-        if isinstance(result, list) and len(result) > 0 and isinstance(result[0], Path):
-            for item in result:
-                self.cache.set(item.path, item)
+        if len(items) > 0:
+            self.cache.set_multi(items)
         return
 
-    def listdir(self):
-        return [c.basename(c.path) for c in self.get_content()]
+    def get_paths(self, environ=None):
+        """Return the paths of the children, without fetching the entities themselves.
+
+        This is cached in its own slot next to the content list, with the same version.
+        """
+        cache = self.get_cache(environ)
+        version = cache.get_list_version(self.path)
+        result = cache.get_list(self.path, version, prefix="paths")
+        if result is not None:
+            logging.debug("Dir.get_paths: HIT %r" % result)
+            return result
+        records = cache.get_list(self.path, version)
+        if records:
+            return [record.path for record in records]
+        result = list(Path.ilist_paths_by_parent_path(self))
+        logging.debug("Dir.get_paths: MISS %r" % result)
+        cache.set_list(self.path, result, version=version, prefix="paths")
+        return result
+
+    def listdir(self, environ=None):
+        return [self.basename(p) for p in self.get_paths(environ)]
 
     def ilistdir(self):
         for c in self.iget_content():
@@ -373,14 +974,7 @@ class Dir(Path):
             for p in self.iget_content():
                 raise RuntimeError("Dir must be empty")
         else:
-            for p in self.get_content():
-                logging.debug(f"Dir.delete({recursive}): {self.path!r}, p={p!r}")
-                if type(p) is Dir:
-                    p.delete(recursive)
-                elif type(p) is File:
-                    p.delete()
-                else:
-                    raise RuntimeError("invalid child type")
+            return self.delete_tree()
         # for d in self.dir_set:
         #     logging.debug("Dir.delete(%s): %r, d=%r" % (recursive, self.path, d))
         #     d.delete(recursive)
@@ -390,6 +984,33 @@ class Dir(Path):
         Path.delete(self)
         return
 
+    def delete_tree(self):
+        """
+        Delete this directory with its whole subtree in bulk: collect the keys of all
+        descendant paths and their chunks first, then delete them in parallel batches.
+        """
+        logging.debug(f"Dir.delete_tree: {self.path!r}")
+        if self.path == "/":
+            raise RuntimeError("Though shalt not delete root")
+        items = list(Path.ilist_by_prefix(self.path))
+        files = [item for item in items if item.isfile()]
+        # derive the chunk keys where possible, and query the others (keys only)
+        chunk_keys = []
+        for keys in db.run_parallel(File.get_chunk_keys, files):
+            chunk_keys.extend(keys)
+        path_keys = [item.key() for item in items]
+        # delete the chunks before the paths, and this directory last
+        db.delete_multi(chunk_keys)
+        db.delete_multi(path_keys)
+        db.delete(self.key())
+        Dir.add_aggregates(self.path, count=-1, size=-sum(item.size for item in files))
+        self.cache.delete_multi([self.path] + [item.path for item in items])
+        self.cache.del_list_multi(
+            [os.path.dirname(self.path), self.path]
+            + [item.path for item in items if item.isdir()]
+        )
+        return
+
     def rmdir(self):
         self.delete(recursive=False)
 
@@ -397,11 +1018,21 @@ class Dir(Path):
         self.delete(recursive=True)
 
 
+# don't lose the pending aggregates at shutdown, or apply them twice in a forked child
+atexit.register(Dir._flush_at_exit)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Dir._after_fork)
+
+
 # ===============================================================================
 # File
 # ===============================================================================
 class File(Path):
     ChunkSize = 800 * 1024  # split file to chunks at most 800K
+    BatchSize = 8 * 1024 * 1024  # put chunks in batches of at most 8M per request
+    ReadAhead = 4  # fetch up to 4 chunks concurrently when reading
+    ReadAheadBytes = 8 * 1024 * 1024  # with at most 8M of chunks held in memory
+    InlineSize = 16 * 1024  # keep files up to 16K inline in the file entity
 
     # parent_path = db.ReferenceProperty(Path)
     # content = db.BlobProperty(default='')
@@ -413,9 +1044,73 @@ class File(Path):
 
     # cache = cached_file
 
+    _template = {
+        "parent_path": None,
+        "content_key": None,
+    }
+
     def _init_entity(self, **kwargs):
         super()._init_entity(**kwargs)
         self._entity.setdefault("parent_path", None)
+        # chunks of new files go under their own content key, so they never mix with
+        # the chunks of another file that was renamed away from the same path
+        self._entity.setdefault("content_key", self.new_content_key())
+
+    @classmethod
+    def new_content_key(cls):
+        return db.get_client().key("Content", uuid.uuid4().hex)
+
+    def get_content_key(self):
+        """
+        Return the parent key of the chunks - this is the file key for older files.
+        """
+        return self._entity.get("content_key") or self.key()
+
+    def is_inline(self):
+        """
+        Return True if the content is kept inline in the file entity, without chunks.
+        """
+        if self._inline_omitted:
+            # made from a directory listing record, so get the data now
+            self.load_entity()
+        return "inline_data" in self._entity
+
+    def load_entity(self):
+        super().load_entity()
+        self._inline_omitted = False
+
+    def _get_record_content(self, inline=True):
+        content_key = self._entity.get("content_key")
+        inline_data = self._entity.get("inline_data")
+        if self._inline_omitted or (not inline and inline_data is not None):
+            # only in the record of the path itself, not in the directory listings
+            inline_data = True
+        return (
+            content_key.flat_path if content_key else None,
+            self._entity.get("chunk_size"),
+            inline_data,
+        )
+
+    # set for instances made from a listing record without the inline_data
+    _inline_omitted = False
+    # properties of the entity before begin_write(), to restore in abort_write()
+    _write_backup = None
+    _write_properties = (
+        "content_key",
+        "size",
+        "inline_data",
+        "chunk_size",
+        "modify_time",
+    )
+    # background worker for collect_content() - see start_content_gc()
+    _gc_condition = threading.Condition()
+    _gc_worker = None
+
+    def _renamed(self, path, parent_key):
+        result = super()._renamed(path, parent_key)
+        # keep the chunks where they are
+        result._entity["content_key"] = self.get_content_key()
+        return result
 
     def put(self):
         if self.is_saved():
@@ -434,26 +1129,104 @@ class File(Path):
         """
         Join chunks together.
         """
-        if self.is_saved():
-            # chunks = Chunk.gql("WHERE file=:1 ORDER BY offset ASC", self)
-            chunks = Chunk.fetch_entities_by_file(self)
-        else:
-            chunks = []
-        result = b"".join(chunk["data"] for chunk in chunks)
+        result = b"".join(self.iget_content())
         # logging.debug('Content: %s' % repr(result))
         return result
 
-    def iget_content(self):
+    def iget_content(self, read_ahead=None, max_bytes=None):
         """
-        Return chunks via iterable.
+        Return chunks via iterable, fetching the next chunks concurrently.
         """
-        if self.is_saved():
-            # chunks = Chunk.gql("WHERE file=:1 ORDER BY offset ASC", self)
-            chunks = Chunk.fetch_entities_by_file(self)
-        else:
-            chunks = []
-        for chunk in chunks:
-            yield chunk["data"]
+        if not self.is_saved():
+            return
+        if self.is_inline():
+            yield self._entity["inline_data"]
+            return
+        if read_ahead is None:
+            read_ahead = self.ReadAhead
+        if max_bytes is None:
+            max_bytes = self.ReadAheadBytes
+        # limit the number of chunks in memory (fetched but not consumed yet)
+        read_ahead = min(read_ahead, max_bytes // self.ChunkSize)
+        total = 0
+        for chunk in self._iget_chunks(self.get_chunk_keys(), read_ahead):
+            data = Chunk.get_data(chunk)
+            total += len(data)
+            yield data
+        if total != self.size:
+            # e.g. chunks missing at the end, or the wrong content key
+            raise RuntimeError(
+                "Content of %r has %d bytes instead of %d"
+                % (self.path, total, self.size)
+            )
+
+    def _iget_chunks(self, chunk_keys, read_ahead):
+        for key, chunk in zip(chunk_keys, db.iget_entities(chunk_keys, read_ahead)):
+            if chunk is None:
+                raise RuntimeError("Missing chunk %r for %r" % (key, self.path))
+            yield chunk
+
+    def read_range(self, offset, length=None):
+        """
+        Return length bytes of content starting at offset (or up to the end),
+        fetching only the chunks needed for this range.
+        """
+        if offset < 0:
+            raise ValueError("negative offset %r" % offset)
+        end = self.size if length is None else min(self.size, offset + length)
+        if not self.is_saved() or offset >= end:
+            return b""
+        result = []
+        for chunk_offset, data in self.iget_range_chunks(offset, end):
+            result.append(data[max(0, offset - chunk_offset) : end - chunk_offset])
+        return b"".join(result)
+
+    def iget_range_chunks(self, start, end, read_ahead=None):
+        """
+        Return (offset, data) via iterable for the chunks overlapping start:end.
+        """
+        if self.is_inline():
+            yield 0, self._entity["inline_data"]
+            return
+        chunk_size = self._entity.get("chunk_size")
+        if not chunk_size:
+            # chunks saved before chunk_size was set may not be aligned
+            for chunk in Chunk.fetch_entities_by_range(self, start, end):
+                data = Chunk.get_data(chunk)
+                if chunk["offset"] + len(data) > start:
+                    yield chunk["offset"], data
+            return
+        chunk_keys = [
+            Chunk.get_key_for(self.get_content_key(), offset)
+            for offset in range(start - start % chunk_size, end, chunk_size)
+        ]
+        if read_ahead is None:
+            read_ahead = self.ReadAhead
+        for chunk in self._iget_chunks(chunk_keys, read_ahead):
+            yield chunk["offset"], Chunk.get_data(chunk)
+
+    def get_chunk_at(self, offset):
+        """
+        Return (offset, data) for the chunk containing offset.
+        """
+        for chunk_offset, data in self.iget_range_chunks(offset, offset + 1):
+            return chunk_offset, data
+        return offset, b""
+
+    def get_chunk_keys(self):
+        """
+        Return the chunk keys in offset order - derived from the size if possible.
+        """
+        if self.is_inline():
+            return []
+        chunk_size = self._entity.get("chunk_size")
+        if not chunk_size:
+            # chunks saved before chunk_size was set may not be aligned
+            return Chunk.list_keys_by_file(self, ordered=True)
+        return [
+            Chunk.get_key_for(self.get_content_key(), offset)
+            for offset in range(0, self.size, chunk_size)
+        ]
 
     def put_content(self, s):
         """
@@ -462,23 +1235,12 @@ class File(Path):
         """
         size = len(s)
         # self.content = []
-        if not self.is_saved():
-            logging.debug("No complete key available yet")
-            self.set_key()
-            # raise Exception
-        else:
-            # clear old chunks
-            self.truncate()
+        self.begin_write()
 
         # put new datas
-        for i in range(0, size, self.ChunkSize):
-            logging.debug("File.put_content putting the chunk with offset = %d" % i)
-            data = s[i : i + self.ChunkSize]
-            # ck = Chunk(file=self.key(), offset=i, data=data, parent=self.key())  # use parent here?
-            ck = Chunk(offset=i, data=data, parent=self.key())
-            ck.put()
-        self.size = size
-        self.put()
+        self._put_chunks(
+            s[i : i + self.ChunkSize] for i in range(0, size, self.ChunkSize)
+        )
         return
 
     def iput_content(self, iterable):
@@ -488,30 +1250,251 @@ class File(Path):
         """
         # size = len(s)
         # self.content = []
+        self.begin_write()
+
+        # put new datas
+        self._put_chunks(iterable)
+        return
+
+    def begin_write(self):
+        """
+        Prepare to write new content - see put_chunk() and commit_write().
+
+        The new chunks go under a new content key, and the old content stays as it is
+        until commit_write() switches the file entity to the new content key in the
+        same put as the last chunks. So readers never see partial content, and if
+        the write fails the new chunks are deleted again (see abort_write).
+        """
+        self.load_entity()
         if not self.is_saved():
             logging.debug("No complete key available yet")
             self.set_key()
             # raise Exception
+        elif self._write_backup is None:
+            self._write_backup = {
+                name: self._entity[name]
+                for name in self._write_properties
+                if name in self._entity
+            }
+            # the old chunks (if any) are deleted later - see commit_write()
+            self._entity["content_key"] = self.new_content_key()
+
+    def abort_write(self):
+        """
+        Discard the new content since begin_write() - the file entity keeps pointing
+        to the old content, and the chunks put for the new content are deleted.
+        """
+        if self._write_backup is None:
+            return
+        new_content_key = self.get_content_key()
+        for name in self._write_properties:
+            if name in self._write_backup:
+                self._entity[name] = self._write_backup[name]
+            else:
+                self._entity.pop(name, None)
+        self._write_backup = None
+        # nobody reads the new content yet
+        self.delete_content_later(new_content_key, delay=0)
+
+    def put_chunk(self, offset, data):
+        """
+        Put a single chunk of new content - offset must be aligned on ChunkSize.
+        """
+        logging.debug("File.put_chunk putting the chunk with offset = %d" % offset)
+        ck = self.new_chunk(offset, data)
+        ck.put()
+
+    def new_chunk(self, offset, data):
+        # ck = Chunk(file=self.key(), offset=i, data=data, parent=self.key())  # use parent here?
+        return Chunk.new_for(self.get_content_key(), offset, data)
+
+    def commit_write(self, size, batch=None, chunk_size=ChunkSize, inline_data=None):
+        """
+        Save the File entity with its new size, together with the last chunks in batch
+        - or with the whole content as inline_data if it is small enough (no chunks).
+
+        This is a single transaction, so the file entity never points to the new
+        content key unless the last chunks were saved too. The content it replaces
+        is marked for deletion in the same transaction (see DeletedContent).
+        """
+        batch = batch or []
+        self.load_entity()
+        self.size = size
+        if inline_data is not None:
+            self._entity["inline_data"] = inline_data
+            self._entity.exclude_from_indexes.add("inline_data")
+            chunk_size = None
         else:
-            # clear old chunks
-            self.truncate()
+            self._entity.pop("inline_data", None)
+        if chunk_size:
+            # all chunks are aligned on chunk_size now, so we can derive their keys
+            self._entity["chunk_size"] = chunk_size
+        else:
+            self._entity.pop("chunk_size", None)
+        self.set_auto_now()
+        batch.append(self._entity)
+        logging.debug("File.commit_write putting %d chunks + file" % (len(batch) - 1))
+        client = db.get_client()
+        with client.transaction():
+            # replace the content the file has now, not the one we loaded before - in
+            # case another writer committed in the meantime
+            current = client.get(self.key())
+            old_size = (current.get("size") or 0) if current else 0
+            # no chunks for inline or empty content
+            if old_size and "inline_data" not in current:
+                replaced_key = current.get("content_key") or current.key
+                if replaced_key != self.get_content_key():
+                    batch.append(DeletedContent.new_for(replaced_key)._entity)
+            client.put_multi(batch)
+        # only once it's committed
+        Dir.add_aggregates(self.path, size=size - old_size)
+        self.update_cache()
+        self._write_backup = None
+        self.start_content_gc()
+        return
 
-        # put new datas
+    @classmethod
+    def delete_content_later(cls, content_key, delay=None):
+        """
+        Delete the chunks under content_key after CONTENT_GC_DELAY - see collect_content().
+        """
+        DeletedContent.new_for(content_key, delay).put()
+        cls.start_content_gc(wakeup=True)
+
+    @classmethod
+    def start_content_gc(cls, wakeup=False):
+        """
+        Start the background worker that collects the DeletedContent that is due.
+        """
+        with cls._gc_condition:
+            # one worker for all deletes - not on the db executor, since delete_multi()
+            # runs its batches there (and the worker is gone in a forked child)
+            if cls._gc_worker is None or not cls._gc_worker.is_alive():
+                cls._gc_worker = threading.Thread(
+                    target=cls._run_gc, name="content-gc", daemon=True
+                )
+                cls._gc_worker.start()
+            elif wakeup:
+                cls._gc_condition.notify()
+
+    @classmethod
+    def _run_gc(cls):
+        while True:
+            try:
+                cls.collect_content()
+            except Exception as e:
+                logging.warning("File.collect_content: %s" % e)
+            with cls._gc_condition:
+                cls._gc_condition.wait(CONTENT_GC_INTERVAL)
+
+    @classmethod
+    def collect_content(cls, force=False):
+        """
+        Delete the chunks of the DeletedContent that is due, saved by this process or
+        any other - or all of it with force, e.g. for tests or maintenance. Returns
+        the number of chunks deleted.
+        """
+        query = DeletedContent.query()
+        if not force:
+            query.add_filter("delete_time", "<=", datetime.datetime.now(datetime.UTC))
+        query.keys_only()
+        total = 0
+        for entity in query.fetch():
+            total += Chunk.delete_by_content_key(entity.key.parent)
+            db.delete(entity.key)
+        return total
+
+    def _put_chunks(self, iterable):
+        """
+        Put the chunks with put_multi in batches of at most BatchSize bytes,
+        and save the File entity itself with the last batch.
+        """
+        batch = []
+        batch_size = 0
         i = 0
-        for data in iterable:
-            logging.debug("File.iput_content putting the chunk with offset = %d" % i)
+        for data in self._iter_aligned(iterable):
             length = len(data)
-            if length > self.ChunkSize:
-                # TODO: split data into chunks as above
-                raise ValueError("Too much data received: %s" % length)
-            # ck = Chunk(file=self.key(), offset=i, data=data, parent=self.key())  # use parent here?
-            ck = Chunk(offset=i, data=data, parent=self.key())
-            ck.put()
+            if i == 0 and length <= self.InlineSize:
+                # this is the first and last chunk, so keep it inline
+                self.commit_write(length, inline_data=data)
+                return
+            if len(batch) > 0 and (
+                batch_size + length > self.BatchSize
+                or len(batch) + 1 >= db.MAX_BATCH_ENTITIES
+            ):
+                logging.debug("File._put_chunks putting %d chunks" % len(batch))
+                db.put_multi(batch)
+                batch = []
+                batch_size = 0
+            logging.debug("File._put_chunks adding the chunk with offset = %d" % i)
+            ck = self.new_chunk(i, data)
+            batch.append(ck._entity)
+            batch_size += length
             i += length
-        self.size = i
-        self.put()
+        self.commit_write(i, batch)
         return
 
+    def copy_content(self, src):
+        """
+        Copy the content of src by cloning its chunk entities under this file,
+        in parallel batches - without joining or splitting the data again.
+        """
+        if src.get_content_key() == self.get_content_key():
+            return
+        self.begin_write()
+        try:
+            chunk_keys = src.get_chunk_keys()
+            batch_count = max(1, self.BatchSize // self.ChunkSize)
+            batches = [
+                chunk_keys[i : i + batch_count]
+                for i in range(0, len(chunk_keys), batch_count)
+            ]
+            cloned = sum(db.run_parallel(self._clone_chunks, batches, self.ReadAhead))
+            if cloned != len(chunk_keys):
+                # get_multi() leaves out the missing chunks
+                raise RuntimeError(
+                    "Missing chunks for %r: found %d of %d"
+                    % (src.path, cloned, len(chunk_keys))
+                )
+            self.commit_write(
+                src.size,
+                chunk_size=src._entity.get("chunk_size"),
+                inline_data=src._entity.get("inline_data"),
+            )
+        except BaseException:
+            # delete the chunks cloned so far - the file keeps its old content
+            self.abort_write()
+            raise
+        return
+
+    def _clone_chunks(self, chunk_keys):
+        batch = []
+        for entity in db.get_client().get_multi(chunk_keys):
+            key = db.get_client().key(
+                Chunk._kind, entity.key.id_or_name, parent=self.get_content_key()
+            )
+            batch.append(db.make_entity(key, Chunk._exclude_from_indexes, **entity))
+        logging.debug("File._clone_chunks putting %d chunks" % len(batch))
+        db.put_multi(batch)
+        return len(batch)
+
+    def _iter_aligned(self, iterable):
+        """
+        Split or join the data received into chunks of exactly ChunkSize,
+        except for the last one.
+        """
+        buffer = bytearray()
+        for data in iterable:
+            if len(buffer) == 0 and len(data) == self.ChunkSize:
+                yield data
+                continue
+            buffer.extend(data)
+            while len(buffer) >= self.ChunkSize:
+                yield bytes(buffer[: self.ChunkSize])
+                del buffer[: self.ChunkSize]
+        if len(buffer) > 0:
+            yield bytes(buffer)
+
     def download(self, file):
         # Note: we always write in chunks here, regardless of the chunk_size
         for data in self.iget_content():
@@ -524,6 +1507,12 @@ class File(Path):
             return 0
         if size is not None and size > 0:
             raise NotImplementedError
+        if self.is_inline():
+            # no chunks to clear here
+            self._entity.pop("inline_data")
+            self.size = 0
+            self.cache.delete(self.path)
+            return 0
         # clear old chunks
         # for chunk in self.chunk_set:  # use ancestor instead?
         #    chunk.delete()
@@ -548,12 +1537,17 @@ class File(Path):
         logging.debug("File.delete %s" % repr(self.path))
         # for chunk in self.chunk_set:  # use ancestor instead?
         #    chunk.delete()
-        chunk_keys = Chunk.list_keys_by_file(self)
-        if chunk_keys and len(chunk_keys) > 0:
-            db.get_client().delete_multi(chunk_keys)
         Path.delete(self)
+        if not self.is_inline() and self.size:
+            self.start_content_gc()
         return
 
+    def _deleted_entities(self):
+        if self.is_inline() or not self.size:
+            return []
+        # delete the chunks later, in the same transaction as the file entity
+        return [DeletedContent.new_for(self.get_content_key())._entity]
+
     def unlink(self):
         self.delete()
 
@@ -566,41 +1560,142 @@ class Chunk(db.Model):
     # offset = db.IntegerProperty(required=True)
     # data = db.BlobProperty(default=b'')
     _kind = "Chunk"
-    _exclude_from_indexes = ["data"]
+    _exclude_from_indexes = ["data", "codec"]
     _auto_now_add = None
     _auto_now = None
+    # codec name -> (encode, decode) functions for the chunk data
+    _codecs = {
+        "zlib": (zlib.compress, zlib.decompress),
+    }
+
+    _template = {
+        #'file': None,
+        "offset": 0,
+        "data": b"",
+    }
 
     def _init_entity(self, **kwargs):
         super()._init_entity(**kwargs)
-        template = {
-            #'file': None,
-            "offset": 0,
-            "data": b"",
-        }
-        for key in template:
-            self._entity.setdefault(key, template[key])
+        for key in self._template:
+            self._entity.setdefault(key, self._template[key])
 
     def __len__(self):
-        return len(self.data)
+        return len(self.get_data(self._entity))
+
+    @classmethod
+    def register_codec(cls, name, encode, decode):
+        cls._codecs[name] = (encode, decode)
+
+    @classmethod
+    def encode(cls, data, codec=None):
+        """
+        Return (codec, data) with the data encoded by codec - or (None, data)
+        if the encoded data would not be smaller.
+        """
+        if codec is None:
+            codec = CHUNK_CODEC
+        if not codec or not data:
+            return None, data
+        encoded = cls._codecs[codec][0](data)
+        if len(encoded) >= len(data):
+            return None, data
+        return codec, encoded
+
+    @classmethod
+    def get_data(cls, entity):
+        """
+        Return the decoded data of a chunk entity.
+        """
+        codec = entity.get("codec")
+        if not codec:
+            return entity["data"]
+        if codec not in cls._codecs:
+            raise RuntimeError("Unknown codec %r for chunk %r" % (codec, entity.key))
+        return cls._codecs[codec][1](entity["data"])
+
+    @classmethod
+    def get_id_for(cls, offset):
+        # chunk ids are derived from the offset (ids must be > 0)
+        return offset + 1
+
+    @classmethod
+    def get_key_for(cls, parent, offset):
+        return db.get_client().key(cls._kind, cls.get_id_for(offset), parent=parent)
+
+    @classmethod
+    def new_for(cls, parent, offset, data):
+        codec, data = cls.encode(data)
+        chunk = cls(
+            offset=offset, data=data, parent=parent, key_name=cls.get_id_for(offset)
+        )
+        if codec:
+            chunk._entity["codec"] = codec
+        return chunk
 
     @classmethod
     def fetch_entities_by_file(cls, file):
         # chunks = Chunk.gql("WHERE file=:1 ORDER BY offset ASC", self)
         # query = db.get_client().query(kind=cls._kind)  # use ancestor instead?
-        query = db.get_client().query(kind=cls._kind, ancestor=file.key())
+        query = db.get_client().query(kind=cls._kind, ancestor=file.get_content_key())
         # query.add_filter('file', '=', file.key())
         query.order = ["offset"]
         return query.fetch()
 
     @classmethod
-    def list_keys_by_file(cls, file):
+    def fetch_entities_by_range(cls, file, start, end):
+        query = db.get_client().query(kind=cls._kind, ancestor=file.get_content_key())
+        # chunks are at most File.ChunkSize, so the first one we need starts after this
+        query.add_filter("offset", ">", start - file.ChunkSize)
+        query.add_filter("offset", "<", end)
+        query.order = ["offset"]
+        return query.fetch()
+
+    @classmethod
+    def list_keys_by_file(cls, file, ordered=False):
         # chunks = Chunk.gql("WHERE file=:1 ORDER BY offset ASC", self)
         # query = db.get_client().query(kind=cls._kind)  # use ancestor instead?
-        query = db.get_client().query(kind=cls._kind, ancestor=file.key())
+        query = db.get_client().query(kind=cls._kind, ancestor=file.get_content_key())
         query.keys_only()
         # query.add_filter('file', '=', file.key())
+        if ordered:
+            query.order = ["offset"]
         result = []
         for entity in query.fetch():
             result.append(entity.key)
         return result
         # return db.list_entity_keys(cls._kind, ancestor=file.key())
+
+    @classmethod
+    def delete_by_content_key(cls, content_key):
+        query = db.get_client().query(kind=cls._kind, ancestor=content_key)
+        query.keys_only()
+        chunk_keys = [entity.key for entity in query.fetch()]
+        logging.debug("Chunk.delete_by_content_key %d chunks" % len(chunk_keys))
+        if len(chunk_keys) > 0:
+            db.delete_multi(chunk_keys)
+        return len(chunk_keys)
+
+
+# ===============================================================================
+# DeletedContent
+# ===============================================================================
+class DeletedContent(db.Model):
+    """
+    Chunks of replaced or deleted content to delete after delete_time - saved under
+    the content key in the same transaction as the file, see File.collect_content().
+    """
+
+    _kind = "DeletedContent"
+    _exclude_from_indexes = None
+    _auto_now_add = None
+    _auto_now = None
+
+    @classmethod
+    def new_for(cls, content_key, delay=None):
+        if delay is None:
+            delay = CONTENT_GC_DELAY
+        delete_time = datetime.datetime.now(datetime.UTC) + datetime.timedelta(
+            seconds=delay
+        )
+        # one per content key, so marking it again only moves the delete_time
+        return cls(parent=content_key, key_name="deleted", delete_time=delete_time)
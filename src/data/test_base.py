@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2019-2020 Mike's Pub, see https://github.com/mikespub-org
+# Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
+#
+import logging
+import threading
+
+from google.cloud.datastore.query import Or, PropertyFilter
+
+from . import db
+from . import fs as data_fs
+from .base import BaseClient
+from .cache import memcache3
+from .model import Dir
+
+
+def check_client(client):
+    parent = client.key("Test", "parent")
+    entities = []
+    for i in range(10):
+        entity = db.make_entity(client.key("Test", "item%d" % i, parent=parent))
+        entity.update({"number": i, "even": i % 2 == 0, "tags": ["all", "t%d" % i]})
+        entities.append(entity)
+    other = db.make_entity(client.key("Test"), exclude_from_indexes=["number"])
+    other.update({"number": 42, "even": True})
+    entities.append(other)
+    client.put_multi(entities)
+    assert not other.key.is_partial
+    assert client.get(other.key)["number"] == 42
+
+    query = client.query(kind="Test", ancestor=parent, order=["-number"])
+    result = list(query.fetch())
+    assert [entity["number"] for entity in result] == list(range(9, -1, -1))
+
+    # the number of other is not indexed
+    query = client.query(kind="Test", filters=[("number", ">=", 5)])
+    assert len(list(query.fetch())) == 5
+    query = client.query(kind="Test")
+    query.add_filter(filter=PropertyFilter("tags", "=", "t3"))
+    assert [entity["number"] for entity in query.fetch()] == [3]
+    query = client.query(kind="Test")
+    query.add_filter(
+        filter=Or([PropertyFilter("number", "<", 2), PropertyFilter("number", ">", 8)])
+    )
+    assert len(list(query.fetch())) == 3
+
+    query = client.query(kind="Test", projection=["number"], order=["number"])
+    result = list(query.fetch(limit=3))
+    assert [dict(entity) for entity in result] == [{"number": i} for i in range(3)]
+    query = client.query(kind="Test")
+    query.keys_only()
+    assert len(list(query.fetch())) == 11
+
+    query = client.query(kind="Test", order=["number"])
+    result, cursor = db.fetch_page(query, 4)
+    assert [entity["number"] for entity in result] == [0, 1, 2, 3]
+    result, cursor = db.fetch_page(query, 4, cursor)
+    assert [entity["number"] for entity in result] == [4, 5, 6, 7]
+    result, cursor = db.fetch_page(query, 4, cursor)
+    assert [entity["number"] for entity in result] == [8, 9]
+    assert cursor is None
+
+    with client.transaction():
+        client.delete(other.key)
+        assert client.get(other.key) is not None
+    assert client.get(other.key) is None
+    missing = []
+    client.get_multi([other.key], missing=missing)
+    assert len(missing) == 1
+
+    # the current batch is per thread, like in the datastore client
+    with client.batch():
+        thread = threading.Thread(target=client.put, args=(other,))
+        thread.start()
+        thread.join()
+        assert client.get(other.key) is not None
+        client.delete(other.key)
+    assert client.get(other.key) is None
+
+    assert "Test" in db.list_kinds()
+    assert "number" in db.get_properties_for_kind("Test")
+    client.delete_multi([entity.key for entity in entities])
+
+
+def check_fs():
+    # Test data_fs.py against the in-memory client
+    data_fs.initfs()
+    assert data_fs.isdir("/")
+    data_fs.mkdir("/base_test")
+    data = b"x" * 1024
+    for i in range(5):
+        with data_fs.btopen("/base_test/file%d.txt" % i, "w") as fp:
+            fp.write(data)
+    assert sorted(data_fs.listdir("/base_test")) == ["file%d.txt" % i for i in range(5)]
+    assert data_fs.getfile("/base_test/file3.txt").get_content() == data
+    data_fs.rename("/base_test/file3.txt", "/base_test/moved.txt")
+    assert not data_fs.exists("/base_test/file3.txt")
+    assert data_fs.btopen("/base_test/moved.txt").read() == data
+    data_fs.rmtree("/base_test")
+    assert not data_fs.exists("/base_test")
+
+
+def test():
+    logging.info("test.test()")
+
+    client = BaseClient(latency=0.001)
+    # don't leave the other tests with this client or the cached records
+    memcache3.reset()
+    try:
+        with db.client_manager.use_client(client):
+            check_client(client)
+            check_fs()
+            # roll up the pending directory aggregates before switching back
+            Dir.flush_aggregates()
+    finally:
+        memcache3.reset()
+    print("*** data_fs tests passed with %r ***" % client.stats)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,150 @@
+#
+# Copyright (c) 2019-2020 Mike's Pub, see https://github.com/mikespub-org
+# Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
+#
+import threading
+from contextlib import contextmanager
+
+from . import cache as data_cache
+from .cache import CacheStats, LocalCache, NamespacedCache, RequestCache, memcache3
+
+
+@contextmanager
+def two_processes(namespace):
+    # two caches with their own local cache in front of the same memcache3, like in
+    # two worker processes - checking for invalidations on every get
+    settings = (data_cache.USE_LOCAL_CACHE, data_cache.LOCAL_CACHE_CHECK_INTERVAL)
+    data_cache.USE_LOCAL_CACHE = True
+    data_cache.LOCAL_CACHE_CHECK_INTERVAL = 0
+    memcache3.reset()
+    try:
+        yield NamespacedCache(namespace, True), NamespacedCache(namespace, True)
+    finally:
+        data_cache.USE_LOCAL_CACHE, data_cache.LOCAL_CACHE_CHECK_INTERVAL = settings
+        memcache3.reset()
+
+
+def test_request_cache():
+    memcache3.reset()
+    cache = NamespacedCache("test_request")
+    environ = {}
+    request = RequestCache(cache, environ)
+    cache.set("/a", "v1")
+    assert request.get("/a") == "v1"
+    # the request keeps its copy, without going back to memcache3
+    memcache3.set("test_request:/a", "v2")
+    assert request.get("/a") == "v1"
+    # and shares it with the other request caches in the same environ
+    assert RequestCache(cache, environ).get("/a") == "v1"
+    assert RequestCache(cache, {}).get("/a") == "v2"
+    # until something is deleted from the cache
+    cache.delete("/other")
+    assert request.get("/a") == "v2"
+    # the items set during the request are kept too
+    request.set_local_multi({"/b": "local"})
+    assert request.get("/b") == "local"
+    assert cache.get("/b") is None
+    memcache3.reset()
+
+
+def test_local_cache():
+    local = LocalCache("test_local", max_bytes=1000, timeout=30)
+    local.set("a", b"x" * 400)
+    local.set("b", b"y" * 400)
+    assert local.get("a") == b"x" * 400
+    # the least recently used item goes first
+    local.set("c", b"z" * 400)
+    assert local.get("b") is None
+    assert local.get("a") is not None
+    assert local._bytes <= local.max_bytes
+    # items that are too big for the cache are not kept
+    local.set("d", b"w" * 2000)
+    assert local.get("d") is None
+    local.set("e", "expired", timeout=-1)
+    local._items["e"] = (0, local._items["e"][1])
+    assert local.get("e") is None
+
+
+def test_local_invalidation():
+    with two_processes("test_local") as (a, b):
+        a.set("/f", "v1")
+        assert b.get("/f") == "v1"
+        # b has its own copy now, but doesn't keep it after a changes it
+        a.set("/f", "v2")
+        a.del_list("/")
+        assert b.get("/f") == "v2"
+        a.set_multi({"/f": "v3", "/g": "v3"})
+        assert b.get("/f") == "v3"
+        assert b.get("/g") == "v3"
+        a.delete("/f")
+        assert b.get("/f") is None
+        # other keys stay in the local cache of b
+        memcache3.set("test_local:/g", "changed")
+        assert b.get("/g") == "v3"
+        b.delete_multi(["/g"])
+        assert a.get("/g") is None
+
+
+def test_list_generations():
+    memcache3.reset()
+    cache = NamespacedCache("test_list")
+    version = cache.get_list_version("/d")
+    cache.set_list("/d", ["a"], version=version)
+    assert cache.get_list("/d") == ["a"]
+    # a reader that started before the change still has the old version
+    old_version = cache.get_list_version("/d")
+    cache.del_list("/d")
+    assert cache.get_list_version("/d") > old_version
+    assert cache.get_list("/d") is None
+    cache.set_list("/d", ["a"], version=old_version)
+    assert cache.get_list("/d") is None
+    cache.set_list("/d", ["a", "b"])
+    assert cache.get_list("/d") == ["a", "b"]
+    # the lists of other directories are not affected
+    cache.set_list("/e", ["c"])
+    cache.del_list_multi(["/d", "/f"])
+    assert cache.get_list("/d") is None
+    assert cache.get_list("/e") == ["c"]
+    memcache3.reset()
+
+
+def test_stats():
+    memcache3.reset()
+    stats = CacheStats()
+    stats.incr("test_stats", "hits")
+
+    def work():
+        for i in range(100):
+            stats.incr("test_stats", "hits")
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stats.get_counters()[("test_stats", "hits")] == 401
+    # the counters of the finished threads are added up, instead of kept per thread
+    stats.incr("test_stats", "misses")
+    assert len(stats._threads) == 1
+    stats.timing("test_stats", "get", 0.003)
+    counters = stats.get_counters()
+    assert counters[("test_stats", "get_count")] == 1
+    assert counters[("test_stats", "get_ms_le_5")] == 1
+    # the totals of all processes, without counting a flush twice
+    other = CacheStats()
+    other.incr("test_stats", "hits", 10)
+    other.flush()
+    stats.flush()
+    stats.flush()
+    assert stats.get_totals()[("test_stats", "hits")] == 411
+    result = stats.get_stats()
+    assert result["process"]["test_stats"]["hits"] == 401
+    assert result["total"]["test_stats"]["misses"] == 1
+    memcache3.reset()
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("*** cache tests passed ***")
@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2019-2020 Mike's Pub, see https://github.com/mikespub-org
+# Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
+#
+import threading
+
+from . import db
+from .base import BaseClient
+
+
+def put_numbers(client, kind, count):
+    entities = []
+    for i in range(count):
+        entity = db.make_entity(client.key(kind, "item%02d" % i))
+        entity["number"] = i
+        entities.append(entity)
+    client.put_multi(entities)
+
+
+def test_pages():
+    with db.client_manager.use_client(BaseClient()) as client:
+        put_numbers(client, "TestPage", 25)
+        numbers = []
+        cursor = None
+        pages = 0
+        while True:
+            result, cursor = db.list_entities_page(
+                "TestPage", 10, cursor, order=["number"]
+            )
+            numbers.extend(entity["number"] for entity in result)
+            pages += 1
+            if cursor is None:
+                break
+            # the cursor is an opaque string, e.g. for the X-Next-Cursor header
+            assert isinstance(cursor, str)
+        assert numbers == list(range(25))
+        assert pages == 3
+        keys, cursor = db.list_entity_keys_page("TestPage", 20, order=["number"])
+        assert len(keys) == 20
+        keys, cursor = db.list_entity_keys_page(
+            "TestPage", 20, cursor, order=["number"]
+        )
+        assert [key.name for key in keys] == ["item%02d" % i for i in range(20, 25)]
+        assert cursor is None
+        # the list functions continue from a start_cursor too
+        result, cursor = db.list_entities_page("TestPage", 5, order=["number"])
+        result = db.list_entities("TestPage", 3, start_cursor=cursor, order=["number"])
+        assert [entity["number"] for entity in result] == [5, 6, 7]
+
+
+def get_thread_clients(manager, count=8):
+    # start all threads at once, to initialize the manager concurrently
+    barrier = threading.Barrier(count)
+    clients = [None] * count
+
+    def work(i):
+        barrier.wait()
+        clients[i] = (manager.get_client(), manager.get_client())
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients
+
+
+def test_client_manager():
+    backend = db.CLIENT_BACKEND
+    db.CLIENT_BACKEND = "base"
+    try:
+        manager = db.ClientManager(mode="shared")
+        clients = get_thread_clients(manager)
+        assert len({id(client) for pair in clients for client in pair}) == 1
+        assert isinstance(clients[0][0], BaseClient)
+
+        manager = db.ClientManager(mode="thread")
+        clients = get_thread_clients(manager)
+        # the same client within a thread, and its own client for each thread
+        assert all(first is second for first, second in clients)
+        assert len({id(first) for first, second in clients}) == len(clients)
+        # made from one base client, so they see the same entities
+        put_numbers(clients[0][0], "TestClient", 1)
+        assert clients[1][0].get(clients[1][0].key("TestClient", "item00"))
+        first = manager.get_client()
+        assert manager.get_client() is first
+        manager.close()
+        assert manager.get_client() is not first
+
+        # a test client for all threads, and the previous one again afterwards
+        other = BaseClient()
+        with manager.use_client(other):
+            clients = get_thread_clients(manager, 2)
+            assert all(first is other for first, second in clients)
+        assert manager.get_client() is not other
+        assert manager.mode == "thread"
+    finally:
+        db.CLIENT_BACKEND = backend
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("*** db tests passed ***")
@@ -0,0 +1,444 @@
+#
+# Copyright (c) 2019-2020 Mike's Pub, see https://github.com/mikespub-org
+# Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
+#
+import asyncio
+import datetime
+import io
+import os
+from contextlib import contextmanager
+
+from . import aio, db
+from . import fs as data_fs
+from .base import BaseClient, BaseTransaction
+from .cache import memcache3
+from .model import Chunk, Dir, File, Path, UnmappedPath
+
+# 2.5 chunks with a different byte at each offset (mod 251), to check where we read
+LARGE_DATA = bytes(i % 251 for i in range(File.ChunkSize * 5 // 2))
+SMALL_DATA = b"small file content"
+
+
+@contextmanager
+def offline():
+    # each test gets its own in-memory client, and leaves no cached records behind
+    client = BaseClient()
+    memcache3.reset()
+    try:
+        with db.client_manager.use_client(client):
+            data_fs.initfs()
+            yield client
+            # run the pending background work against this client
+            Dir.flush_aggregates()
+            File.collect_content(force=True)
+    finally:
+        memcache3.reset()
+
+
+@contextmanager
+def failing_commits():
+    # every transaction fails to commit, e.g. when the datastore is unavailable
+    commit = BaseTransaction.commit
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("commit failed")
+
+    BaseTransaction.commit = fail
+    try:
+        yield
+    finally:
+        BaseTransaction.commit = commit
+
+
+def get_aggregates(path):
+    Dir.flush_aggregates()
+    memcache3.reset()
+    return Path.retrieve(path).get_aggregates()
+
+
+def write_file(path, data):
+    with data_fs.btopen(path, "w") as fp:
+        fp.write(data)
+
+
+def read_exactly(fp, length):
+    # a raw BtReader returns at most the rest of the current chunk per read()
+    result = bytearray()
+    while len(result) < length:
+        data = fp.read(length - len(result))
+        if not data:
+            break
+        result.extend(data)
+    return bytes(result)
+
+
+def count_chunks(client):
+    query = client.query(kind=Chunk._kind)
+    query.keys_only()
+    return len(list(query.fetch()))
+
+
+def make_legacy_file(client, path, data):
+    # a file saved before the content keys, with its chunks under the file key
+    key = Path.get_key_for(path)
+    now = datetime.datetime.now(datetime.UTC)
+    entity = db.make_entity(key)
+    entity.update(
+        {
+            "path": path,
+            "parent_path": Path.get_key_for(os.path.dirname(path)),
+            "class": ["Path", "File"],
+            "size": len(data),
+            "create_time": now,
+            "modify_time": now,
+        }
+    )
+    chunks = []
+    for offset in range(0, len(data), File.ChunkSize):
+        chunk = db.make_entity(Chunk.get_key_for(key, offset), ["data"])
+        chunk.update({"offset": offset, "data": data[offset : offset + File.ChunkSize]})
+        chunks.append(chunk)
+    client.put_multi([entity] + chunks)
+
+
+def test_rename():
+    with offline():
+        data_fs.mkdir("/src")
+        data_fs.mkdir("/src/sub")
+        write_file("/src/small.txt", SMALL_DATA)
+        write_file("/src/sub/large.bin", LARGE_DATA)
+        content_key = data_fs.getfile("/src/sub/large.bin").get_content_key()
+        data_fs.rename("/src", "/dst")
+        assert not data_fs.exists("/src")
+        assert not data_fs.exists("/src/sub/large.bin")
+        assert sorted(data_fs.listdir("/dst")) == ["small.txt", "sub"]
+        assert data_fs.getfile("/dst/small.txt").get_content() == SMALL_DATA
+        moved = data_fs.getfile("/dst/sub/large.bin")
+        # the chunks stay where they are
+        assert moved.get_content_key() == content_key
+        assert moved.get_content() == LARGE_DATA
+        try:
+            data_fs.rename("/dst", "/dst/sub/loop")
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("renamed a directory into itself")
+
+
+def test_read_range():
+    chunk_size = File.ChunkSize
+    with offline():
+        write_file("/large.bin", LARGE_DATA)
+        f = data_fs.getfile("/large.bin")
+        assert f.read_range(0, 10) == LARGE_DATA[:10]
+        # across a chunk boundary
+        start = chunk_size - 5
+        assert f.read_range(start, 10) == LARGE_DATA[start : start + 10]
+        assert f.read_range(2 * chunk_size) == LARGE_DATA[2 * chunk_size :]
+        assert f.read_range(len(LARGE_DATA)) == b""
+        assert f.read_range(len(LARGE_DATA) - 3, 100) == LARGE_DATA[-3:]
+        try:
+            f.read_range(-5, 10)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("read a negative offset")
+
+
+def test_reader_seek():
+    chunk_size = File.ChunkSize
+    with offline():
+        write_file("/large.bin", LARGE_DATA)
+        with data_fs.btopen("/large.bin") as fp:
+            assert fp.seekable()
+            assert read_exactly(fp, 100) == LARGE_DATA[:100]
+            # random access in a later chunk, and back again
+            fp.seek(2 * chunk_size + 7)
+            assert read_exactly(fp, 50) == LARGE_DATA[2 * chunk_size + 7 :][:50]
+            fp.seek(chunk_size - 10)
+            assert read_exactly(fp, 20) == LARGE_DATA[chunk_size - 10 :][:20]
+            assert fp.tell() == chunk_size + 10
+            fp.seek(-5, io.SEEK_CUR)
+            assert read_exactly(fp, 5) == LARGE_DATA[chunk_size + 5 :][:5]
+            fp.seek(-4, io.SEEK_END)
+            assert fp.read() == LARGE_DATA[-4:]
+            assert fp.read(10) == b""
+            # sequential read of the rest with the chunks fetched ahead
+            fp.seek(3)
+            assert read_exactly(fp, len(LARGE_DATA)) == LARGE_DATA[3:]
+
+
+def test_writer_commit_error():
+    with offline() as client:
+        write_file("/file.bin", LARGE_DATA)
+        fp = data_fs.btopen("/file.bin", "w")
+        fp.write(SMALL_DATA * 100000)
+        try:
+            with failing_commits():
+                fp.close()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("closed without an error")
+        # the writer was aborted, and the file keeps its old content
+        assert fp.closed
+        assert fp.btfile._write_backup is None
+        assert fp.btfile.size == len(LARGE_DATA)
+        memcache3.reset()
+        assert data_fs.getfile("/file.bin").get_content() == LARGE_DATA
+        # and the chunks written for the new content are deleted again
+        File.collect_content(force=True)
+        assert count_chunks(client) == 3
+
+
+def test_deleted_content():
+    with offline() as client:
+        write_file("/file.bin", LARGE_DATA)
+        # two writers at once - each one replaces the content that is there when it
+        # commits, so the content of the first one isn't left behind
+        first = data_fs.btopen("/file.bin", "w")
+        second = data_fs.btopen("/file.bin", "w")
+        first.write(LARGE_DATA)
+        second.write(LARGE_DATA[::-1])
+        first.close()
+        second.close()
+        assert count_chunks(client) == 9
+        # the old content is kept in the datastore for readers, not in this process
+        query = client.query(kind="DeletedContent")
+        assert len(list(query.fetch())) == 2
+        assert File.collect_content() == 0
+        assert File.collect_content(force=True) == 6
+        memcache3.reset()
+        assert data_fs.getfile("/file.bin").get_content() == LARGE_DATA[::-1]
+        # and the same for deleted files
+        data_fs.unlink("/file.bin")
+        assert len(list(query.fetch())) == 1
+        assert File.collect_content(force=True) == 3
+        assert count_chunks(client) == 0
+        assert len(list(query.fetch())) == 0
+
+
+def test_copyfile():
+    with offline() as client:
+        write_file("/src.bin", LARGE_DATA)
+        write_file("/small.txt", SMALL_DATA)
+        data_fs.copyfile("/src.bin", "/dst.bin")
+        data_fs.copyfile("/small.txt", "/copy.txt")
+        src = data_fs.getfile("/src.bin")
+        dst = data_fs.getfile("/dst.bin")
+        assert dst.get_content_key() != src.get_content_key()
+        assert dst.get_content() == LARGE_DATA
+        assert data_fs.getfile("/copy.txt").get_content() == SMALL_DATA
+        assert count_chunks(client) == 6
+        # a source with a missing chunk isn't copied
+        client.delete(src.get_chunk_keys()[1])
+        try:
+            data_fs.copyfile("/src.bin", "/copy.txt")
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("copied a file with a missing chunk")
+        memcache3.reset()
+        assert data_fs.getfile("/copy.txt").get_content() == SMALL_DATA
+
+
+def test_rename_listings():
+    with offline():
+        data_fs.mkdir("/x")
+        assert data_fs.listdir("/x") == []
+        data_fs.rmdir("/x")
+        data_fs.mkdir("/y")
+        write_file("/y/a.txt", SMALL_DATA)
+        data_fs.rename("/y", "/x")
+        # not the empty listing cached for the old /x
+        assert data_fs.listdir("/x") == ["a.txt"]
+        assert data_fs.getdir("/x").get_paths() == ["/x/a.txt"]
+
+
+def test_delete_tree():
+    with offline() as client:
+        data_fs.mkdir("/tree")
+        data_fs.mkdir("/tree/sub")
+        write_file("/tree/large.bin", LARGE_DATA)
+        write_file("/tree/sub/large.bin", LARGE_DATA)
+        write_file("/tree/sub/small.txt", SMALL_DATA)
+        write_file("/keep.bin", LARGE_DATA)
+        assert count_chunks(client) == 9
+        data_fs.rmtree("/tree")
+        assert not data_fs.exists("/tree")
+        assert not data_fs.exists("/tree/sub/small.txt")
+        # only the chunks of /keep.bin are left
+        assert count_chunks(client) == 3
+        assert data_fs.getfile("/keep.bin").get_content() == LARGE_DATA
+
+
+def test_chunk_codec():
+    random_data = os.urandom(File.ChunkSize + 10)
+    with offline() as client:
+        write_file("/large.bin", LARGE_DATA)
+        write_file("/random.bin", random_data)
+        chunk = client.get(data_fs.getfile("/large.bin").get_chunk_keys()[0])
+        assert chunk["codec"] == "zlib"
+        assert len(chunk["data"]) < File.ChunkSize
+        # data that doesn't get smaller is kept as it is
+        chunk = client.get(data_fs.getfile("/random.bin").get_chunk_keys()[0])
+        assert not chunk.get("codec")
+        assert chunk["data"] == random_data[: File.ChunkSize]
+        assert data_fs.getfile("/large.bin").get_content() == LARGE_DATA
+        assert data_fs.getfile("/random.bin").get_content() == random_data
+
+
+def test_inline():
+    with offline() as client:
+        write_file("/file.txt", SMALL_DATA)
+        f = data_fs.getfile("/file.txt")
+        assert f.is_inline()
+        assert count_chunks(client) == 0
+        # promote to chunks
+        write_file("/file.txt", LARGE_DATA)
+        memcache3.reset()
+        f = data_fs.getfile("/file.txt")
+        assert not f.is_inline()
+        assert f.get_content() == LARGE_DATA
+        assert count_chunks(client) == 3
+        # demote to inline again - the old chunks are deleted in the background
+        write_file("/file.txt", SMALL_DATA)
+        memcache3.reset()
+        f = data_fs.getfile("/file.txt")
+        assert f.is_inline()
+        assert f.get_content() == SMALL_DATA
+        assert File.collect_content(force=True) == 3
+        assert count_chunks(client) == 0
+
+
+def test_not_found():
+    with offline() as client:
+        assert Path.retrieve("/missing.txt") is None
+        assert isinstance(Path.cache.get("/missing.txt"), UnmappedPath)
+        # the next lookups don't go to the datastore
+        stats = dict(client.stats)
+        assert Path.retrieve("/missing.txt") is None
+        assert Path.retrieve_multi(["/missing.txt"]) == {"/missing.txt": None}
+        assert client.stats == stats
+        # and creating the path replaces the cached entry
+        write_file("/missing.txt", SMALL_DATA)
+        assert Path.retrieve("/missing.txt").get_content() == SMALL_DATA
+
+
+def test_legacy_file_rename():
+    with offline() as client:
+        data_fs.mkdir("/old")
+        make_legacy_file(client, "/old/f.bin", LARGE_DATA)
+        data_fs.rename("/old", "/new")
+        # the renamed file keeps its chunks under the old file key
+        assert data_fs.getfile("/new/f.bin").get_content_key().flat_path == (
+            "Path",
+            "/old/f.bin",
+        )
+        assert data_fs.getfile("/new/f.bin").get_content() == LARGE_DATA
+        # also from the cached record
+        assert Path.cache.get("/new/f.bin") is not None
+        assert data_fs.getfile("/new/f.bin").get_content() == LARGE_DATA
+        data_fs.copyfile("/new/f.bin", "/new/copy.bin")
+        assert data_fs.getfile("/new/copy.bin").get_content() == LARGE_DATA
+        # a missing chunk is an error, not a shorter file
+        client.delete(Chunk.get_key_for(Path.get_key_for("/old/f.bin"), 0))
+        memcache3.reset()
+        try:
+            data_fs.getfile("/new/f.bin").get_content()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("read a file with a missing chunk")
+
+
+def test_get_paths():
+    with offline():
+        data_fs.mkdir("/dir")
+        data_fs.mkdir("/dir/sub")
+        write_file("/dir/file.txt", SMALL_DATA)
+        d = data_fs.getdir("/dir")
+        assert sorted(d.get_paths()) == ["/dir/file.txt", "/dir/sub"]
+        # cached now, and invalidated by new entries
+        assert sorted(d.get_paths()) == ["/dir/file.txt", "/dir/sub"]
+        write_file("/dir/other.txt", SMALL_DATA)
+        assert sorted(d.listdir()) == ["file.txt", "other.txt", "sub"]
+        data_fs.unlink("/dir/file.txt")
+        assert sorted(d.listdir()) == ["other.txt", "sub"]
+        # the names are cached apart from the listing of a directory "/dir#paths"
+        data_fs.mkdir("/dir#paths")
+        write_file("/dir#paths/x.txt", SMALL_DATA)
+        environ = {}
+        assert sorted(data_fs.getdir("/dir", environ).get_paths(environ)) == [
+            "/dir/other.txt",
+            "/dir/sub",
+        ]
+        other = data_fs.getdir("/dir#paths", environ)
+        assert [p.path for p in other.get_content(environ)] == ["/dir#paths/x.txt"]
+
+
+def test_aio():
+    async def main():
+        await aio.mkdir("/aio")
+        await aio.put_content("/aio/small.txt", SMALL_DATA)
+        await aio.put_content("/aio/large.bin", LARGE_DATA)
+        assert sorted(await aio.listdir("/aio")) == ["large.bin", "small.txt"]
+        result = await aio.get_content_multi(["/aio/small.txt", "/aio/large.bin"])
+        assert result == [SMALL_DATA, LARGE_DATA]
+        chunks = [data async for data in aio.iget_content("/aio/large.bin")]
+        assert b"".join(chunks) == LARGE_DATA
+        await aio.unlink("/aio/small.txt")
+        assert await aio.retrieve("/aio/small.txt") is None
+        await aio.rmtree("/aio")
+        assert await aio.retrieve("/aio") is None
+
+    with offline():
+        asyncio.run(main())
+
+
+def test_aggregates():
+    size = len(LARGE_DATA)
+    with offline():
+        data_fs.mkdir("/a")
+        data_fs.mkdir("/a/b")
+        write_file("/a/b/large.bin", LARGE_DATA)
+        write_file("/a/small.txt", SMALL_DATA)
+        assert get_aggregates("/a/b") == (1, size)
+        assert get_aggregates("/a") == (2, size + len(SMALL_DATA))
+        # overwrite with other content
+        write_file("/a/b/large.bin", SMALL_DATA)
+        assert get_aggregates("/a/b") == (1, len(SMALL_DATA))
+        assert get_aggregates("/a") == (2, 2 * len(SMALL_DATA))
+        data_fs.unlink("/a/small.txt")
+        assert get_aggregates("/a") == (1, len(SMALL_DATA))
+        # rename with a directory instance that was read before the writes
+        b = Path.retrieve("/a/b")
+        write_file("/a/b/large.bin", LARGE_DATA)
+        write_file("/a/b/other.bin", LARGE_DATA)
+        b.rename("/c")
+        assert get_aggregates("/c") == (2, 2 * size)
+        assert get_aggregates("/a") == (0, 0)
+        # writes and deletes that fail don't count
+        with failing_commits():
+            for func, args in (
+                (write_file, ("/c/large.bin", SMALL_DATA)),
+                (data_fs.unlink, ("/c/other.bin",)),
+            ):
+                try:
+                    func(*args)
+                except RuntimeError:
+                    pass
+                else:
+                    raise AssertionError("committed anyway")
+        assert get_aggregates("/c") == (2, 2 * size)
+        # with the /dav directory made by initfs()
+        assert get_aggregates("/") == (3, 2 * size)
+        data_fs.rmtree("/c")
+        assert get_aggregates("/") == (2, 0)
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("*** offline tests passed ***")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark for attribute access on data.db.Model instances
+#
+
+
+def make_legacy_class():
+    from data.model import File
+
+    class LegacyFile(File):
+        """File with the previous attribute access via __getattribute__ for comparison"""
+
+        def __setattr__(self, key, value):
+            if not key.startswith("_") and self._entity:
+                self._entity[key] = value
+                return
+            object.__setattr__(self, key, value)
+
+        def __getattribute__(self, key):
+            if not key.startswith("_") and self._entity and key in self._entity:
+                return self._entity[key]
+            return object.__getattribute__(self, key)
+
+    return LegacyFile
+
+
+def main(number=100000, *args):
+    import datetime
+    import timeit
+
+    from google.cloud.datastore import Entity
+
+    from data.model import File
+
+    number = int(number)
+    now = datetime.datetime.now(datetime.UTC)
+    entity = Entity()
+    entity.update(
+        {
+            "path": "/dav/bench.txt",
+            "parent_path": None,
+            "class": ["Path", "File"],
+            "size": 1234,
+            "create_time": now,
+            "modify_time": now,
+            "content_key": None,
+        }
+    )
+    result = {}
+    for cls in (make_legacy_class(), File):
+        instance = cls(_from_entity=entity)
+        timings = {}
+        for label, stmt in (
+            ("get", "instance.path; instance.size; instance.modify_time"),
+            ("set", "instance.size = 1234"),
+            ("private", "instance._entity; instance._partial"),
+            ("method", "instance.isfile"),
+        ):
+            seconds = timeit.timeit(stmt, globals={"instance": instance}, number=number)
+            timings[label] = "%.3f us" % (seconds * 1000000 / number)
+        result[cls.__name__] = timings
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+    from pprint import pprint
+
+    if len(sys.argv) > 1:
+        result = main(*sys.argv[1:])
+    else:
+        print("%s [<number>]" % "python3 -m data.try_model_access")
+        result = main()
+
+    pprint(result)
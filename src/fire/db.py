@@ -3,6 +3,7 @@
 # Licensed under the MIT license: https://opensource.org/licenses/mit-license.php
 #
 import os.path
+import threading
 
 from google.cloud import firestore
 
@@ -13,18 +14,65 @@ GOOGLE_APPLICATION_CREDENTIALS = None
 
 # cached_doc = NamespacedCache("doc")
 
-_client = None
+# how firestore clients are shared between threads: "shared" uses one client for all
+# threads, and "pool" hands out one of CLIENT_POOL_SIZE clients to each thread. Each
+# client has its own gRPC channel, and firestore already sets keepalive options on it,
+# so the clients are created once and re-used instead of one cold channel per thread.
+CLIENT_MODE = "shared"
+CLIENT_POOL_SIZE = 4
+
+
+class ClientManager:
+    """Hand out firestore clients to threads, re-using the same clients"""
+
+    def __init__(self, mode=CLIENT_MODE, pool_size=CLIENT_POOL_SIZE):
+        self.mode = mode
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # incremented by close() to invalidate the thread clients
+        self._generation = 0
+        self._clients = []
+        self._count = 0
+
+    def get_client(self, project_id=None, cred_file=GOOGLE_APPLICATION_CREDENTIALS):
+        entry = getattr(self._local, "entry", None)
+        if entry is not None and entry[0] == self._generation:
+            return entry[1]
+        with self._lock:
+            size = self.pool_size if self.mode == "pool" else 1
+            if len(self._clients) < size:
+                client = self.make_client(project_id, cred_file)
+                self._clients.append(client)
+            else:
+                self._count += 1
+                client = self._clients[self._count % size]
+            self._local.entry = (self._generation, client)
+        return client
+
+    def set_client(self, client):
+        """Use this client for all threads, e.g. for testing"""
+        with self._lock:
+            self._generation += 1
+            self.mode = "shared"
+            self._clients = [client]
+
+    def make_client(self, project_id=None, cred_file=GOOGLE_APPLICATION_CREDENTIALS):
+        if cred_file and os.path.isfile(cred_file):
+            return firestore.Client.from_service_account_json(cred_file)
+        return firestore.Client(project_id)
+
+    def close(self):
+        with self._lock:
+            self._generation += 1
+            self._clients = []
+
+
+client_manager = ClientManager()
 
 
 def get_client(project_id=None, cred_file=GOOGLE_APPLICATION_CREDENTIALS):
-    global _client
-    if _client is not None:
-        return _client
-    if cred_file and os.path.isfile(cred_file):
-        _client = firestore.Client.from_service_account_json(cred_file)
-    else:
-        _client = firestore.Client(project_id)
-    return _client
+    return client_manager.get_client(project_id, cred_file)
 
 
 def to_dict(ref):
@@ -48,7 +96,4 @@ def get_coll_ref(path):
 
 
 def close():
-    global _client
-    if _client is not None:
-        # _client.close()
-        _client = None
+    client_manager.close()